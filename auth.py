@@ -1,11 +1,21 @@
+import asyncio
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from fastapi import HTTPException, status
 import secrets
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", "2"))
+AUTH_QUEUE_LIMIT = int(os.getenv("AUTH_QUEUE_LIMIT", "32"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 ALGORITHM = "HS256"
@@ -18,6 +28,40 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+class PasswordWorkerPool:
+    """Пул потоков для bcrypt: хэширование не блокирует event loop,
+    а при переполнении очереди запросы сразу получают 503."""
+
+    def __init__(self, workers: int = AUTH_WORKERS, queue_limit: int = AUTH_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth")
+
+    async def run(self, func, *args):
+        if self.pending >= self.queue_limit:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Сервер перегружен, попробуйте позже",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+password_pool = PasswordWorkerPool()
+
+async def ahash_password(password: str) -> str:
+    return await password_pool.run(hash_password, password)
+
+async def averify_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_pool.run(verify_password, plain_password, hashed_password)
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -37,4 +81,47 @@ def verify_token(token: str) -> dict:
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Недействительный токен",
             headers={"WWW-Authenticate": "Bearer"},
-        )
\ No newline at end of file
+        )
+
+class TokenCache:
+    """LRU-кэш проверенных access-токенов; запись живёт не дольше exp самого токена."""
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return payload
+
+    def put(self, token: str, payload: dict):
+        expires_at = payload.get("exp")
+        if not expires_at:
+            return
+        with self._lock:
+            self._entries[token] = (payload, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, token: str):
+        with self._lock:
+            self._entries.pop(token, None)
+
+token_cache = TokenCache()
+
+def verify_token_cached(token: str) -> dict:
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = verify_token(token)
+        token_cache.put(token, payload)
+    return payload
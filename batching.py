@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Union
+
+from cancellation import CancelToken
+from metrics import BATCH_QUEUE_WAIT, BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+BATCH_WINDOW_MS = float(os.getenv("GENERATION_BATCH_WINDOW_MS", "20"))
+BATCH_MAX_SIZE = int(os.getenv("GENERATION_BATCH_MAX_SIZE", "8"))
+# 0 — по числу процессов инференса, а без пула — STREAM_DEFAULT_CONCURRENCY
+STREAM_MAX_CONCURRENT = int(os.getenv("GENERATION_STREAM_MAX_CONCURRENT", "0"))
+STREAM_DEFAULT_CONCURRENCY = 4
+
+class BatchStats:
+    """Статистика по батчам генерации для подбора окна и размера батча."""
+
+    def __init__(self, recent_size: int = 100):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.prompts = 0
+        self.failed_batches = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.total_generate_seconds = 0.0
+        self.size_histogram = Counter()
+        self.recent = deque(maxlen=recent_size)
+
+    def record(self, size: int, wait_seconds: List[float], generate_seconds: float, failed: bool = False):
+        with self._lock:
+            self.batches += 1
+            self.prompts += size
+            self.failed_batches += int(failed)
+            self.total_wait_seconds += sum(wait_seconds)
+            self.max_wait_seconds = max(self.max_wait_seconds, *wait_seconds)
+            self.total_generate_seconds += generate_seconds
+            self.size_histogram[size] += 1
+            self.recent.append({
+                "size": size,
+                "max_wait_ms": round(max(wait_seconds) * 1000, 2),
+                "generate_ms": round(generate_seconds * 1000, 2),
+                "failed": failed,
+            })
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "prompts": self.prompts,
+                "failed_batches": self.failed_batches,
+                "avg_batch_size": self.prompts / self.batches if self.batches else 0.0,
+                "avg_wait_ms": self.total_wait_seconds / self.prompts * 1000 if self.prompts else 0.0,
+                "max_wait_ms": self.max_wait_seconds * 1000,
+                "avg_generate_ms": self.total_generate_seconds / self.batches * 1000 if self.batches else 0.0,
+                "prompts_per_generate_second": self.prompts / self.total_generate_seconds if self.total_generate_seconds else 0.0,
+                "size_histogram": dict(sorted(self.size_histogram.items())),
+                "recent": list(self.recent),
+            }
+
+class FairQueue:
+    """Асинхронная очередь с круговым обходом владельцев: get() берёт по одному элементу
+    у каждого владельца по очереди, поэтому пачка промптов одного пользователя не задерживает остальных.
+    Внутри очереди одного владельца порядок FIFO.
+    """
+
+    def __init__(self):
+        self._queues: Dict[Hashable, deque] = {}
+        # Владельцы с непустой очередью в порядке обхода
+        self._order: deque = deque()
+        self._size = 0
+        self._not_empty = asyncio.Event()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    @property
+    def owners(self) -> int:
+        return len(self._order)
+
+    def put_nowait(self, owner: Hashable, item):
+        queue = self._queues.get(owner)
+        if queue is None:
+            queue = self._queues[owner] = deque()
+            self._order.append(owner)
+        queue.append(item)
+        self._size += 1
+        self._not_empty.set()
+
+    async def get(self):
+        while self._size == 0:
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if self._size == 0:
+            raise asyncio.QueueEmpty
+        owner = self._order.popleft()
+        queue = self._queues[owner]
+        item = queue.popleft()
+        if queue:
+            self._order.append(owner)
+        else:
+            del self._queues[owner]
+        self._size -= 1
+        if self._size == 0:
+            self._not_empty.clear()
+        return item
+
+class GenerationScheduler:
+    """Собирает промпты за короткое окно (или до максимального размера батча)
+    и прогоняет их одним вызовом run_batch; каждый результат возвращается своему запросу.
+
+    run_batch(prompts, cancels) может быть обычной функцией (выполняется в потоке) или корутиной;
+    одновременно выполняется не больше max_inflight_batches батчей. cancels — токены отмены по промптам:
+    отменённый до старта промпт в батч не попадает, а уже идущий останавливается на ближайшем токене.
+    Промпты разных владельцев (пользователей) попадают в батчи по кругу, а не в порядке поступления.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[str], List[CancelToken]], Union[List[str], Awaitable[List[str]]]],
+        window_ms: float = BATCH_WINDOW_MS,
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_inflight_batches: int = 1,
+    ):
+        self.run_batch = run_batch
+        self.window_seconds = window_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_inflight_batches = max(1, max_inflight_batches)
+        self._inflight: Optional[asyncio.Semaphore] = None
+        self._running = set()
+        self.stats = BatchStats()
+        self._queue: Optional[FairQueue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    @property
+    def pending_owners(self) -> int:
+        return self._queue.owners if self._queue else 0
+
+    async def start(self):
+        if self._task and not self._task.done():
+            return
+        self._queue = FairQueue()
+        self._inflight = asyncio.Semaphore(self.max_inflight_batches)
+        self._task = asyncio.create_task(self._loop())
+        logger.info(
+            f"Планировщик генерации запущен: окно {self.window_seconds * 1000:.0f} мс, "
+            f"батч до {self.max_batch_size}"
+        )
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        while self._queue and not self._queue.empty():
+            _, future, _, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Планировщик генерации остановлен"))
+        logger.info("Планировщик генерации остановлен")
+
+    async def submit(self, prompt: str, cancel: Optional[CancelToken] = None, owner: Optional[Hashable] = None) -> str:
+        """Возвращает ответ на промпт; после отмены — часть, сгенерированную до неё.
+
+        owner — владелец промпта для очерёдности; промпты без владельца обходятся как один владелец.
+        Если ожидающую корутину отменили, генерация промпта тоже отменяется.
+        """
+        await self.start()
+        cancel = cancel or CancelToken()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(owner, (prompt, future, time.perf_counter(), cancel))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            cancel.cancel("disconnect")
+            raise
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._inflight.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._execute(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, batch):
+        try:
+            await self._run(batch)
+        finally:
+            self._inflight.release()
+
+    async def _run(self, batch):
+        # Запросы, которые уже отменены, не занимают место в батче
+        for _, future, _, cancel in batch:
+            if cancel.cancelled and not future.done():
+                future.set_result("")
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+        prompts = [prompt for prompt, _, _, _ in batch]
+        cancels = [cancel for _, _, _, cancel in batch]
+        started = time.perf_counter()
+        wait_seconds = [started - enqueued for _, _, enqueued, _ in batch]
+        BATCH_SIZE.observe(len(batch))
+        for seconds in wait_seconds:
+            BATCH_QUEUE_WAIT.observe(seconds, mode="batch")
+        try:
+            if asyncio.iscoroutinefunction(self.run_batch):
+                results = await self.run_batch(prompts, cancels)
+            else:
+                results = await asyncio.to_thread(self.run_batch, prompts, cancels)
+        except Exception as e:
+            logger.error(f"Ошибка генерации батча из {len(batch)} промптов: {str(e)}")
+            self.stats.record(len(batch), wait_seconds, time.perf_counter() - started, failed=True)
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        generate_seconds = time.perf_counter() - started
+        self.stats.record(len(batch), wait_seconds, generate_seconds)
+        logger.debug(
+            f"Батч из {len(batch)} промптов: ожидание до {max(wait_seconds) * 1000:.0f} мс, "
+            f"генерация {generate_seconds * 1000:.0f} мс"
+        )
+        for (_, future, _, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+class StreamGate:
+    """Допуск потоковых генераций: одновременно идёт не больше limit потоков, остальные ждут в FairQueue
+    и получают место по кругу владельцев — так же, как промпты планировщика батчей.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.active = 0
+        self._waiting = FairQueue()
+
+    @property
+    def pending(self) -> int:
+        return self._waiting.qsize()
+
+    @property
+    def pending_owners(self) -> int:
+        return self._waiting.owners
+
+    @asynccontextmanager
+    async def slot(self, owner: Optional[Hashable] = None) -> AsyncIterator[None]:
+        enqueued = time.perf_counter()
+        if self.active < self.limit and self._waiting.empty():
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiting.put_nowait(owner, future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Место могло достаться уже отменённому ожидающему — тогда оно передаётся следующему
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+        BATCH_QUEUE_WAIT.observe(time.perf_counter() - enqueued, mode="stream")
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        # Отменённые ожидающие остаются в очереди до своей очереди и пропускаются здесь
+        while not self._waiting.empty():
+            future = self._waiting.get_nowait()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "pending": self.pending, "pending_users": self.pending_owners}
@@ -0,0 +1,278 @@
+"""Нагрузочный тест API с детерминированной заглушкой вместо модели.
+
+Приложение запускается в этом же процессе поверх локальной SQLite, запросы идут через ASGI-транспорт httpx,
+так что для прогона не нужны ни GPU, ни сеть. Требуются httpx и aiosqlite.
+
+    python benchmark.py --concurrency 32 --duration 30 --latency-ms 150 --tokens-per-second 25
+
+Результат (p50/p95/p99 по каждому типу запроса и общая пропускная способность) печатается в JSON.
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+DEFAULT_MIX = "poll=10,add_message=3,stream=2,create_chat=1,login=1"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест API со заглушкой LLM")
+    parser.add_argument("--concurrency", type=int, default=16, help="число одновременных виртуальных пользователей")
+    parser.add_argument("--duration", type=float, default=20.0, help="длительность прогона, секунд")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса операций: poll, add_message, stream, create_chat, login")
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="задержка заглушки до первого токена")
+    parser.add_argument("--tokens-per-second", type=float, default=30.0, help="скорость генерации заглушки")
+    parser.add_argument("--completion-tokens", type=int, default=48, help="длина ответа заглушки в токенах")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12, help="стоимость bcrypt для /register и /login")
+    parser.add_argument(
+        "--user-limits", action="store_true",
+        help="оставить ограничения частоты и одновременных генераций на пользователя (по умолчанию выключены)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="файл для JSON-результата (по умолчанию stdout)")
+    return parser.parse_args(argv)
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+class StubConversation:
+    """Заглушка цепочки разговора: одинаковый ответ на одинаковый вход и задержка как у модели."""
+
+    def __init__(self, latency_ms: float, tokens_per_second: float, completion_tokens: int):
+        self.latency = latency_ms / 1000
+        self.token_delay = 1 / tokens_per_second if tokens_per_second > 0 else 0.0
+        self.completion_tokens = completion_tokens
+
+    def tokens(self, content: str) -> List[str]:
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        return [f"{digest[i % len(digest)]}{i} " for i in range(self.completion_tokens)]
+
+    async def ainvoke(self, inputs: dict, config: dict = None) -> str:
+        tokens = self.tokens(inputs["input"])
+        await asyncio.sleep(self.latency + self.token_delay * len(tokens))
+        return "".join(tokens)
+
+    async def astream(self, session_id: str, content: str, cancel=None, owner=None):
+        await asyncio.sleep(self.latency)
+        for token in self.tokens(content):
+            if cancel is not None and cancel.cancelled:
+                return
+            await asyncio.sleep(self.token_delay)
+            yield token
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(
+    latencies: Dict[str, List[float]],
+    errors: Dict[str, int],
+    throttled: Dict[str, int],
+    conflicts: Dict[str, int],
+    elapsed: float
+) -> dict:
+    operations = {}
+    total = 0
+    for name in sorted(set(latencies) | set(errors) | set(throttled) | set(conflicts)):
+        values = sorted(latencies.get(name, []))
+        total += len(values) + errors.get(name, 0) + throttled.get(name, 0) + conflicts.get(name, 0)
+        operations[name] = {
+            "count": len(values),
+            "errors": errors.get(name, 0),
+            # Отказы 429 от ограничений на пользователя — не ошибки приложения
+            "throttled": throttled.get(name, 0),
+            # 409: ответ для чата уже генерируется; в задержки не входит
+            "conflicts": conflicts.get(name, 0),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+            "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+            "throughput_rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        }
+    return {
+        "duration_seconds": round(elapsed, 2),
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "operations": operations,
+    }
+
+class VirtualUser:
+    def __init__(self, client, user_id: int, recorder, stream_replies: bool = False):
+        self.client = client
+        # Если в смеси есть stream, первое сообщение чата отвечается потоком, а не задачей генерации:
+        # иначе stream по этому чату получал бы 409, пока задача не выполнена
+        self.stream_replies = stream_replies
+        self.email = f"bench-{user_id}@example.com"
+        self.password = f"password-{user_id}"
+        self.record = recorder
+        self.chat_id = None
+        self.etag = None
+        self.counter = itertools.count()
+
+    async def timed(self, name: str, request, ok_statuses=(200,)):
+        started = time.perf_counter()
+        try:
+            response = await request
+        except Exception:
+            self.record(name, None)
+            return None
+        elapsed = time.perf_counter() - started
+        if response.status_code in (409, 429):
+            self.record(name, None, response.status_code)
+        else:
+            self.record(name, elapsed if response.status_code in ok_statuses else None)
+        return response
+
+    async def register(self):
+        await self.timed("register", self.client.post(
+            "/register", data={"email": self.email, "password": self.password}
+        ), ok_statuses=(303,))
+
+    async def login(self):
+        await self.timed("login", self.client.post(
+            "/login", data={"email": self.email, "password": self.password}
+        ), ok_statuses=(303,))
+
+    async def create_chat(self):
+        response = await self.timed("create_chat", self.client.post(
+            "/api/chat",
+            params={"generate": "false"} if self.stream_replies else None,
+            json={"content": f"{self.email}: вопрос {next(self.counter)}"}
+        ))
+        if response is not None and response.status_code == 200:
+            self.chat_id = response.json()["chat_id"]
+            self.etag = None
+
+    async def add_message(self):
+        await self.timed("add_message", self.client.post(
+            f"/api/chat/{self.chat_id}/message", json={"content": f"вопрос {next(self.counter)}"}
+        ))
+
+    async def poll(self):
+        # Как браузер: повторный запрос с If-None-Match получает 304, если сообщений не прибавилось
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        response = await self.timed(
+            "poll", self.client.get(f"/api/chat/{self.chat_id}/messages", headers=headers), ok_statuses=(200, 304)
+        )
+        if response is not None and response.status_code == 200:
+            self.etag = response.headers.get("etag")
+
+    async def stream(self):
+        response = await self.client.post(
+            f"/api/chat/{self.chat_id}/message",
+            params={"generate": "false"},
+            json={"content": f"вопрос {next(self.counter)}"}
+        )
+        if response.status_code != 200:
+            self.record("stream", None, response.status_code)
+            return
+        # Учитывается время до полного ответа; ответ потока читается целиком
+        await self.timed("stream", self.client.get(f"/api/chat/{self.chat_id}/stream"))
+
+async def run_benchmark(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="gpt-app-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.sqlite3')}"
+    os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ.setdefault("INFERENCE_WORKERS", "0")
+    if not args.user_limits:
+        # Виртуальный пользователь шлёт генерации подряд с одного аккаунта — иначе прогон измерял бы ограничитель
+        os.environ.setdefault("USER_GENERATIONS_PER_MINUTE", "0")
+        os.environ.setdefault("USER_MAX_CONCURRENT_GENERATIONS", "0")
+
+    import httpx
+    import jobs
+    import main
+
+    stub = StubConversation(args.latency_ms, args.tokens_per_second, args.completion_tokens)
+
+    async def no_inference():
+        pass
+
+    # Модель не загружается: цепочка и потоковая генерация заменены заглушкой
+    main.start_inference = no_inference
+    main.stop_inference = no_inference
+    main.get_conversation_chain = lambda: stub
+    jobs.get_conversation_chain = lambda: stub
+    main.astream_reply = stub.astream
+    # Без модели нет и её токенизатора: длина сообщений оценивается по символам, долговременная память выключена
+    main.token_counter.start = no_inference
+    main.long_term_memory.enabled = False
+    main.long_term_memory.start = no_inference
+
+    random.seed(args.seed)
+    weights = parse_mix(args.mix)
+    names, values = list(weights), list(weights.values())
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    throttled: Dict[str, int] = defaultdict(int)
+    conflicts: Dict[str, int] = defaultdict(int)
+
+    def record(name: str, elapsed, status_code: int = None):
+        if status_code == 429:
+            throttled[name] += 1
+        elif status_code == 409:
+            conflicts[name] += 1
+        elif elapsed is None:
+            errors[name] += 1
+        else:
+            latencies[name].append(elapsed)
+
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+
+        async def user_loop(user_id: int, deadline: float):
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=None) as client:
+                user = VirtualUser(client, user_id, record, stream_replies=weights.get("stream", 0) > 0)
+                await user.register()
+                await user.create_chat()
+                while time.perf_counter() < deadline:
+                    operation = random.choices(names, values)[0]
+                    if user.chat_id is None and operation in ("poll", "add_message", "stream"):
+                        operation = "create_chat"
+                    await getattr(user, operation)()
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(user_loop(user_id, deadline) for user_id in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    result = summarize(latencies, errors, throttled, conflicts, elapsed)
+    result["config"] = {
+        "concurrency": args.concurrency,
+        "duration_seconds": args.duration,
+        "mix": weights,
+        "latency_ms": args.latency_ms,
+        "tokens_per_second": args.tokens_per_second,
+        "completion_tokens": args.completion_tokens,
+        "bcrypt_rounds": args.bcrypt_rounds,
+        "user_limits": args.user_limits,
+    }
+    return result
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run_benchmark(args))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
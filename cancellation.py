@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Set
+
+# 0 — без ограничения времени генерации
+GENERATION_TIMEOUT_SECONDS = float(os.getenv("GENERATION_TIMEOUT_SECONDS", "120"))
+# 1 — при отмене или таймауте сохранять уже сгенерированную часть ответа
+GENERATION_SAVE_PARTIAL = os.getenv("GENERATION_SAVE_PARTIAL", "0") == "1"
+
+class CancelToken:
+    """Признак отмены одной генерации: явная отмена, отключение клиента или истёкший срок.
+
+    Проверяется критерием остановки generate на каждом токене, поэтому должен быть дешёвым и потокобезопасным.
+    Срок задаётся по time.time(), чтобы его можно было передать в процесс инференса.
+    """
+
+    def __init__(self, timeout: float = GENERATION_TIMEOUT_SECONDS, deadline: Optional[float] = None):
+        if deadline is None and timeout > 0:
+            deadline = time.time() + timeout
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.cancel("deadline")
+            return True
+        return False
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        """Вызывает callback при отмене (сразу, если токен уже отменён); истечение срока сюда не попадает."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+# Токен генерации, выполняемой в текущем запросе; его подхватывает LLM цепочки разговора
+current_cancel: ContextVar[Optional[CancelToken]] = ContextVar("current_cancel", default=None)
+
+@contextmanager
+def use_cancel(token: CancelToken):
+    """Делает token токеном отмены для генераций, запущенных внутри блока (через цепочку разговора)."""
+    reset = current_cancel.set(token)
+    try:
+        yield token
+    finally:
+        current_cancel.reset(reset)
+
+class ActiveGenerations:
+    """Генерации, идущие сейчас по чатам, — чтобы их можно было отменить по DELETE."""
+
+    def __init__(self):
+        self._tokens: Dict[int, Set[CancelToken]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, chat_id: int, token: CancelToken):
+        with self._lock:
+            self._tokens.setdefault(chat_id, set()).add(token)
+        try:
+            yield token
+        finally:
+            with self._lock:
+                tokens = self._tokens.get(chat_id)
+                if tokens is not None:
+                    tokens.discard(token)
+                    if not tokens:
+                        del self._tokens[chat_id]
+
+    def cancel(self, chat_id: int, reason: str = "cancelled") -> int:
+        with self._lock:
+            tokens = list(self._tokens.get(chat_id, ()))
+        for token in tokens:
+            token.cancel(reason)
+        return len(tokens)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(tokens) for tokens in self._tokens.values())
+
+active_generations = ActiveGenerations()
@@ -0,0 +1,139 @@
+"""Цепочка разговора на LangChain: промпт, история чата из БД и LLM поверх планировщика генерации.
+
+Модуль импортируется при первом обращении к цепочке, а не при старте API.
+"""
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.language_models.llms import LLM
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from typing import Any, List, Optional, Sequence
+from cancellation import current_cancel
+from history import cached_history, history_cache, load_history, prompt_cutoff
+from memory import long_term_memory
+from stop_sequences import STOP_SEQUENCES, truncate_at_stop
+import llm
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = """Ты — Grok, ИИ-ассистент, созданный xAI. Отвечай только на вопрос пользователя, без повторения запроса или системного промпта. Давай точные, краткие и полезные ответы на русском языке. Если в запросе есть некорректные данные, четко укажи все ошибки и предоставь правильную информацию, основываясь на исторических фактах. Проверяй факты и избегай выдумок."""
+
+MEMORY_PROMPT = "Фрагменты более ранней части этого разговора, которые могут относиться к вопросу:"
+
+def to_chat_message(role: str, content: str) -> BaseMessage:
+    if role == "user":
+        return HumanMessage(content=content)
+    return AIMessage(content=content)
+
+class DatabaseChatMessageHistory(BaseChatMessageHistory):
+    """История чата из таблицы messages.
+
+    Сообщения записывает само приложение строками Message, поэтому add_messages ничего не делает:
+    кэш обновляется после коммита таких строк.
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        # Синхронный доступ к асинхронной БД невозможен — отдаём только то, что уже в кэше
+        return [to_chat_message(role, content) for _, role, content, _ in cached_history(self.chat_id)]
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        return [to_chat_message(role, content) for _, role, content, _ in await load_history(self.chat_id)]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        pass
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        pass
+
+    def clear(self) -> None:
+        history_cache.discard(self.chat_id)
+
+def get_session_history(session_id: str) -> BaseChatMessageHistory:
+    return DatabaseChatMessageHistory(int(session_id))
+
+async def recall_memory(session_id: str, query: str) -> List[BaseMessage]:
+    """Сообщения из долговременной памяти чата, которых нет в окне истории, — одним системным сообщением."""
+    if not long_term_memory.is_ready:
+        return []
+    chat_id = int(session_id)
+    rows = await long_term_memory.recall(chat_id, query, await prompt_cutoff(chat_id))
+    if not rows:
+        return []
+    lines = [f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content}" for _, role, content, _ in rows]
+    return [SystemMessage(content="\n".join([MEMORY_PROMPT, *lines]))]
+
+def _no_memory(inputs: dict) -> List[BaseMessage]:
+    # Синхронный вызов цепочки не может обратиться к БД — промпт собирается без памяти
+    return []
+
+async def _arecall_memory(inputs: dict, config) -> List[BaseMessage]:
+    return await recall_memory(config["configurable"]["session_id"], inputs["input"])
+
+def build_prompt():
+    # Память идёт сразу после системного промпта: закэшированный префикс системного промпта остаётся общим
+    return ChatPromptTemplate.from_messages([
+        ("system", SYSTEM_PROMPT),
+        MessagesPlaceholder(variable_name="memory", optional=True),
+        MessagesPlaceholder(variable_name="history"),
+        ("human", "{input}")
+    ])
+
+def build_conversation_chain(llm, prompt):
+    logger.info("Создание цепочки разговора...")
+    try:
+        chain = RunnablePassthrough.assign(memory=RunnableLambda(_no_memory, afunc=_arecall_memory)) | prompt | llm
+
+        chain_with_history = RunnableWithMessageHistory(
+            chain,
+            get_session_history,
+            input_messages_key="input",
+            history_messages_key="history"
+        )
+        logger.info("Цепочка разговора создана")
+        return chain_with_history
+    except Exception as e:
+        logger.error(f"Ошибка создания цепочки: {str(e)}")
+        raise
+
+class BatchedLLM(LLM):
+    """LLM для цепочки разговора: асинхронные вызовы объединяются в батчи планировщиком."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "batched_huggingface"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        return _apply_stop(llm.generate_batch([prompt], [current_cancel.get()])[0], stop)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        return _apply_stop(await llm.acomplete(prompt), stop)
+
+def _apply_stop(text: str, stop: Optional[List[str]]) -> str:
+    """Метки ролей уже отрезаны при генерации; стоп-последовательности вызывающего применяются поверх."""
+    if not stop:
+        return text
+    return truncate_at_stop(text, STOP_SEQUENCES + tuple(stop))
+
+prompt = build_prompt()
+_chain = None
+_chain_lock = threading.Lock()
+
+def get_conversation_chain():
+    global _chain
+    with _chain_lock:
+        if _chain is None:
+            _chain = build_conversation_chain(BatchedLLM(), prompt)
+    return _chain
+
+async def arender_prompt(session_id: str, content: str) -> str:
+    """Собирает текст промпта так же, как его видит цепочка: системный промпт, память, история и вопрос."""
+    history = await get_session_history(session_id).aget_messages()
+    memory = await recall_memory(session_id, content)
+    return prompt.invoke({"memory": memory, "history": history, "input": content}).to_string()
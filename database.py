@@ -1,22 +1,109 @@
+import logging
 import os
+import time
 from dotenv import load_dotenv
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from typing import AsyncGenerator
+from metrics import DB_POOL_CHECKOUT_WAIT, DB_QUERY_LATENCY
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+SQL_ECHO = os.getenv("SQL_ECHO", "0") == "1"
+# 1 — пересоздавать все таблицы при старте (данные удаляются); только для разработки
+DB_RECREATE = os.getenv("DB_RECREATE", "0") == "1"
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+logger = logging.getLogger(__name__)
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул соединений, который измеряет ожидание соединения при checkout.
+
+    У событий пула нет момента начала ожидания (checkout срабатывает, когда соединение уже получено),
+    поэтому замер идёт вокруг _do_get. Если пул при этом растёт, в замер входит и открытие соединения.
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+# SQLite в памяти работает на одном соединении (StaticPool), очереди пула там нет
+engine_options = {} if ":memory:" in (DATABASE_URL or "") else {"poolclass": TimedQueuePool}
+engine = create_async_engine(DATABASE_URL, echo=SQL_ECHO, **engine_options)
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+    DB_QUERY_LATENCY.observe(time.perf_counter() - started, operation=operation)
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _drop_query_timer(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        connection.info["query_started"].pop()
+
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session() as session:
         yield session
 
 async def init_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        if DB_RECREATE:
+            logger.warning("DB_RECREATE=1: все таблицы пересоздаются")
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+            return
+        await conn.run_sync(_check_schema)
+
+def _check_schema(conn):
+    """Сверяет схему БД с моделями, не трогая данные.
+
+    Недостающие таблицы и индексы создаются, недостающие nullable-столбцы добавляются;
+    при любом другом расхождении старт прерывается — такую схему нужно мигрировать вручную.
+    """
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    missing_tables = [table for table in Base.metadata.sorted_tables if table.name not in existing_tables]
+    if missing_tables:
+        Base.metadata.create_all(conn, tables=missing_tables)
+        logger.info(f"Созданы таблицы: {', '.join(table.name for table in missing_tables)}")
+
+    preparer = conn.dialect.identifier_preparer
+    problems = []
+    for table in Base.metadata.sorted_tables:
+        if table in missing_tables:
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            if not column.nullable or column.primary_key or column.server_default is not None:
+                problems.append(f"{table.name}.{column.name}")
+                continue
+            conn.exec_driver_sql(
+                f"ALTER TABLE {preparer.format_table(table)} "
+                f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=conn.dialect)}"
+            )
+            logger.info(f"Добавлен столбец {table.name}.{column.name}")
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(conn)
+                logger.info(f"Создан индекс {index.name}")
+    if problems:
+        raise RuntimeError(
+            f"Схема БД не совпадает с моделями, отсутствуют столбцы: {', '.join(problems)}. "
+            "Выполните миграцию или запустите с DB_RECREATE=1 (данные будут удалены)"
+        )
\ No newline at end of file
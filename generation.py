@@ -0,0 +1,277 @@
+"""Модель и генерация на её стороне.
+
+Модуль тянет torch, transformers и LangChain, поэтому импортируется только там, где модель действительно
+нужна: в процессе инференса пула или при первой генерации в процессе API.
+"""
+from langchain_huggingface import HuggingFacePipeline
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer, pipeline
+)
+from typing import Iterator, List, Optional, Sequence
+from cancellation import CancelToken
+from chain import build_prompt
+from inference_profile import InferenceProfile, apply_threads, prepare_model, select_profile
+from llm import GENERATION_KWARGS, MODEL_NAME, WARMUP_PROMPT
+from prefix_cache import PREFIX_CACHE_PROMPTS, PrefixCache
+from speculative import SpeculativeDecoder
+from stop_sequences import StopSequenceMatcher, truncate_at_stop
+import metrics
+import logging
+import os
+import threading
+import torch
+import time
+
+logger = logging.getLogger(__name__)
+
+def get_llm(profile: Optional[InferenceProfile] = None):
+    logger.info("Начало загрузки модели...")
+    try:
+        model_name = MODEL_NAME
+        profile = profile or select_profile()
+        apply_threads(profile)
+        device = profile.device
+        logger.info(f"Используемое устройство: {device}")
+
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=profile.torch_dtype,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True
+        ).to(device)
+        model = prepare_model(model, profile)
+        logger.info("Модель загружена успешно")
+
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # Для батчевой генерации decoder-only модели промпты дополняются слева
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        logger.info("Токенизатор загружен")
+
+        hf_pipeline = pipeline(
+            task="text-generation",
+            model=model,
+            tokenizer=tokenizer,
+            **GENERATION_KWARGS,
+            pad_token_id=tokenizer.eos_token_id,
+            device=device,
+            return_full_text=False
+        )
+        logger.info("Пайплайн создан")
+        return HuggingFacePipeline(pipeline=hf_pipeline)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки модели: {str(e)}")
+        raise
+
+class ModelRegistry:
+    """Модель, загружаемая один раз на процесс."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.profile = None
+        self.llm = None
+        self.load_seconds = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def load(self):
+        with self._lock:
+            if self._ready.is_set():
+                return
+            start_time = time.perf_counter()
+            self.profile = select_profile()
+            self.llm = get_llm(self.profile)
+            speculative.load(self.llm.pipeline.model, self.profile, GENERATION_KWARGS)
+            self.warmup()
+            prefill_system_prompt()
+            self.load_seconds = time.perf_counter() - start_time
+            metrics.registry.record("model_load_seconds", "set", self.load_seconds, process=f"pid-{os.getpid()}")
+            self._ready.set()
+            logger.info(f"Модель готова к работе за {self.load_seconds:.2f} секунд")
+
+    def warmup(self):
+        logger.info("Прогрев модели...")
+        start_time = time.perf_counter()
+        self.llm.pipeline(WARMUP_PROMPT, max_new_tokens=1)
+        logger.info(f"Прогрев завершён за {time.perf_counter() - start_time:.2f} секунд")
+
+registry = ModelRegistry()
+
+prefix_cache = PrefixCache()
+speculative = SpeculativeDecoder()
+
+def prefill_system_prompt():
+    """Один раз просчитывает ключи/значения системного промпта, общего для всех запросов."""
+    hf_pipeline = registry.llm.pipeline
+    tokenizer = hf_pipeline.tokenizer
+    model = hf_pipeline.model
+    text = build_prompt().invoke({"history": [], "input": ""}).to_string()
+    input_ids = tokenizer(text, return_tensors="pt").input_ids.to(model.device)
+    with torch.inference_mode():
+        output = model(input_ids=input_ids, use_cache=True)
+    prefix_cache.store("system", input_ids[0], output.past_key_values, pinned=True)
+    logger.info(f"Кэш системного промпта заполнен: {input_ids.shape[1]} токенов")
+
+def record_generation(mode: str, seconds: float, prompt_tokens: List[int], completion_tokens: List[int]):
+    metrics.registry.record("generation_duration_seconds", "observe", seconds, mode=mode)
+    for prompt_length, completion_length in zip(prompt_tokens, completion_tokens):
+        metrics.registry.record("generation_prompt_tokens", "observe", prompt_length)
+        metrics.registry.record("generation_completion_tokens", "observe", completion_length)
+        if seconds > 0:
+            metrics.registry.record("generation_tokens_per_second", "observe", completion_length / seconds)
+
+class CancelCriteria(StoppingCriteria):
+    """Останавливает строки батча, чья генерация отменена; generate завершается, когда остановлены все."""
+
+    def __init__(self, cancels: Sequence[Optional[CancelToken]]):
+        self.cancels = list(cancels)
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        return torch.tensor(
+            [cancel is not None and cancel.cancelled for cancel in self.cancels],
+            dtype=torch.bool,
+            device=input_ids.device
+        )
+
+class StopSequenceCriteria(StoppingCriteria):
+    """Останавливает строку батча, как только в её сгенерированном тексте появилась метка роли.
+
+    Новые токены каждой строки декодируются целиком, а в StopSequenceMatcher подаётся только прирост текста
+    (как в TextIteratorStreamer); пока последний символ не дособран из байтовых токенов, прирост не подаётся.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.matchers: List[StopSequenceMatcher] = []
+        self.decoded: List[int] = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        if not self.matchers:
+            self.matchers = [StopSequenceMatcher() for _ in range(input_ids.shape[0])]
+            self.decoded = [0] * input_ids.shape[0]
+        for row, matcher in enumerate(self.matchers):
+            if matcher.stopped:
+                continue
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            if text.endswith("\ufffd"):
+                continue
+            matcher.feed(text[self.decoded[row]:])
+            self.decoded[row] = len(text)
+        return torch.tensor([matcher.stopped for matcher in self.matchers], dtype=torch.bool, device=input_ids.device)
+
+def stopping_criteria(tokenizer, prompt_length: int, cancels: Optional[Sequence[Optional[CancelToken]]]) -> StoppingCriteriaList:
+    criteria = [StopSequenceCriteria(tokenizer, prompt_length)]
+    if cancels and any(cancel is not None for cancel in cancels):
+        criteria.append(CancelCriteria(cancels))
+    return StoppingCriteriaList(criteria)
+
+def generate_one(inputs, streamer=None, cache_key=None, cancel: Optional[CancelToken] = None) -> torch.Tensor:
+    """Генерирует ответ на один промпт, продолжая с самого длинного закэшированного префикса,
+    или с черновой моделью, если включено спекулятивное декодирование.
+
+    Возвращает идентификаторы новых токенов; при отмене — уже сгенерированную часть. Генерация
+    останавливается на метке роли, но сама метка остаётся в токенах и отрезается при декодировании.
+    """
+    hf_pipeline = registry.llm.pipeline
+    tokenizer = hf_pipeline.tokenizer
+    model = hf_pipeline.model
+    input_ids = inputs["input_ids"]
+    kwargs = {
+        **GENERATION_KWARGS,
+        "pad_token_id": tokenizer.pad_token_id,
+        "stopping_criteria": stopping_criteria(tokenizer, input_ids.shape[1], [cancel])
+    }
+    use_draft = speculative.use()
+    if use_draft:
+        # Кэш черновой модели строится заново, поэтому префикс основной здесь не подставляется
+        kwargs["assistant_model"] = speculative.draft_model
+    else:
+        reused_tokens, past_key_values = prefix_cache.lookup(input_ids[0])
+        if past_key_values is not None:
+            kwargs["past_key_values"] = past_key_values
+            logger.debug(f"Переиспользовано {reused_tokens} из {input_ids.shape[1]} токенов промпта")
+    started = time.perf_counter()
+    with torch.inference_mode(), speculative.track(use_draft):
+        output = model.generate(
+            **inputs,
+            **kwargs,
+            streamer=streamer,
+            return_dict_in_generate=True
+        )
+    new_tokens = output.sequences[0, input_ids.shape[1]:]
+    if use_draft:
+        speculative.record(new_tokens.shape[0])
+    record_generation(
+        "speculative" if use_draft else "single",
+        time.perf_counter() - started,
+        [input_ids.shape[1]],
+        [new_tokens.shape[0]]
+    )
+    if PREFIX_CACHE_PROMPTS:
+        key = cache_key if cache_key is not None else hash(tuple(input_ids[0].tolist()))
+        prefix_cache.store(key, input_ids[0], output.past_key_values)
+    return new_tokens
+
+def generate_batch(prompts: List[str], cancels: Optional[Sequence[Optional[CancelToken]]] = None) -> List[str]:
+    """Генерирует ответы на несколько промптов одним батчевым вызовом generate.
+
+    cancels — токены отмены по промптам; отменённая строка батча останавливается на ближайшем токене.
+    """
+    hf_pipeline = registry.llm.pipeline
+    tokenizer = hf_pipeline.tokenizer
+    model = hf_pipeline.model
+    cancels = list(cancels) if cancels is not None else [None] * len(prompts)
+    if len(prompts) == 1:
+        # Одиночный промпт может продолжить закэшированный префикс; в батче с паддингом позиции сдвинуты
+        inputs = tokenizer(prompts[0], return_tensors="pt").to(model.device)
+        new_tokens = generate_one(inputs, cancel=cancels[0])
+        return [truncate_at_stop(tokenizer.decode(new_tokens, skip_special_tokens=True))]
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    started = time.perf_counter()
+    with torch.inference_mode():
+        output = model.generate(
+            **inputs,
+            **GENERATION_KWARGS,
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=stopping_criteria(tokenizer, inputs["input_ids"].shape[1], cancels)
+        )
+    new_tokens = output[:, inputs["input_ids"].shape[1]:]
+    record_generation(
+        "batch",
+        time.perf_counter() - started,
+        inputs["attention_mask"].sum(dim=1).tolist(),
+        (new_tokens != tokenizer.pad_token_id).sum(dim=1).tolist()
+    )
+    return [truncate_at_stop(text) for text in tokenizer.batch_decode(new_tokens, skip_special_tokens=True)]
+
+def stream_generate(prompt_text: str, cache_key=None, cancel: Optional[CancelToken] = None) -> Iterator[str]:
+    """Генерирует ответ по частям по мере появления токенов; после отмены поток частей заканчивается.
+
+    Части отдаются как есть, вместе с меткой роли, на которой остановилась генерация: её отрезает читатель потока.
+    """
+    hf_pipeline = registry.llm.pipeline
+    tokenizer = hf_pipeline.tokenizer
+    model = hf_pipeline.model
+    inputs = tokenizer(prompt_text, return_tensors="pt").to(model.device)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def run():
+        try:
+            generate_one(inputs, streamer, cache_key, cancel)
+        except BaseException as e:
+            # Без сигнала конца читатель потока ждал бы следующую часть вечно
+            errors.append(e)
+            streamer.end()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    yield from streamer
+    thread.join()
+    if errors:
+        raise errors[0]
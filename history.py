@@ -0,0 +1,220 @@
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from database import async_session
+from models import Message
+from token_counter import estimate_tokens
+
+# Бюджет токенов истории в промпте (без системного промпта и текущего вопроса)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1024"))
+# Предел числа сообщений истории, сколько бы токенов ни оставалось в бюджете
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "32"))
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "1024"))
+# Сообщения, записанные другими процессами API (несколько воркеров uvicorn), кэш сам не видит: при попадании
+# он дочитывает из БД сообщения новее своего хвоста. 0 — только если сообщения пишет один процесс
+HISTORY_CACHE_REVALIDATE = os.getenv("HISTORY_CACHE_REVALIDATE", "1") == "1"
+# Метка роли и перевод строки, которые шаблон промпта добавляет к каждому сообщению
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# (id, role, content, token_count) одного сообщения чата
+HistoryRow = Tuple[int, str, str, Optional[int]]
+
+def row_tokens(row: HistoryRow) -> int:
+    _, _, content, token_count = row
+    if token_count is None:
+        token_count = estimate_tokens(content or "")
+    return token_count + MESSAGE_OVERHEAD_TOKENS
+
+def completed_turns(rows: Sequence[HistoryRow], budget: int = HISTORY_TOKEN_BUDGET) -> List[HistoryRow]:
+    """Самые новые завершённые обмены, которые укладываются в budget токенов.
+
+    Сообщения пользователя без ответа в историю не входят, они подставляются в промпт как текущий вопрос.
+    Длины берутся из сохранённых token_count, без повторной токенизации.
+    """
+    rows = list(rows)
+    while rows and rows[-1][1] == "user":
+        rows.pop()
+    rows = rows[-HISTORY_MAX_MESSAGES:]
+    start = len(rows)
+    used = 0
+    while start > 0:
+        used += row_tokens(rows[start - 1])
+        if used > budget:
+            break
+        start -= 1
+    window = rows[start:]
+    # Ответ, чей вопрос не уместился, без него только сбивает модель
+    while window and window[0][1] != "user":
+        window.pop(0)
+    return window
+
+class HistoryCache:
+    """LRU-кэш хвостов истории активных чатов с ограниченным числом чатов и сообщений."""
+
+    def __init__(self, max_chats: int = HISTORY_CACHE_SIZE, max_messages: int = HISTORY_MAX_MESSAGES):
+        self.max_chats = max_chats
+        # Одно сообщение сверх лимита — под вопрос пользователя, который ещё ждёт ответа
+        self.max_messages = max_messages + 1
+        self._chats: "OrderedDict[int, deque]" = OrderedDict()
+        self._loading: Dict[int, List[HistoryRow]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int) -> Optional[List[HistoryRow]]:
+        with self._lock:
+            rows = self._chats.get(chat_id)
+            if rows is None:
+                self.misses += 1
+                return None
+            self._chats.move_to_end(chat_id)
+            self.hits += 1
+            return list(rows)
+
+    def begin_load(self, chat_id: int):
+        with self._lock:
+            self._loading.setdefault(chat_id, [])
+
+    def finish_load(self, chat_id: int, rows: Sequence[HistoryRow]) -> List[HistoryRow]:
+        """Кладёт загруженный из БД хвост в кэш, добавляя сообщения, записанные во время загрузки."""
+        with self._lock:
+            written = self._loading.pop(chat_id, [])
+            current = self._chats.get(chat_id)
+            if current is not None:
+                # Параллельная загрузка уже заполнила кэш, и он поддерживается в актуальном состоянии
+                return list(current)
+            last_id = rows[-1][0] if rows else 0
+            tail = deque(rows, maxlen=self.max_messages)
+            tail.extend(row for row in written if row[0] > last_id)
+            self._chats[chat_id] = tail
+            self._chats.move_to_end(chat_id)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+            return list(tail)
+
+    def cancel_load(self, chat_id: int):
+        with self._lock:
+            self._loading.pop(chat_id, None)
+
+    def append(self, chat_id: int, row: HistoryRow):
+        with self._lock:
+            if chat_id in self._loading:
+                self._loading[chat_id].append(row)
+            rows = self._chats.get(chat_id)
+            if rows is not None:
+                rows.append(row)
+
+    def merge(self, chat_id: int, rows: Sequence[HistoryRow]) -> Optional[List[HistoryRow]]:
+        """Добавляет к хвосту чата сообщения, прочитанные из БД, без повторов и по порядку id."""
+        with self._lock:
+            current = self._chats.get(chat_id)
+            if current is None:
+                return None
+            if rows:
+                merged = {row[0]: row for row in current}
+                merged.update((row[0], row) for row in rows)
+                current.clear()
+                current.extend(merged[row_id] for row_id in sorted(merged))
+            return list(current)
+
+    def discard(self, chat_id: int):
+        with self._lock:
+            self._chats.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"chats": len(self._chats), "max_chats": self.max_chats, "hits": self.hits, "misses": self.misses}
+
+history_cache = HistoryCache()
+
+def cached_history(chat_id: int) -> List[HistoryRow]:
+    """История из кэша без обращения к БД (для синхронного доступа)."""
+    return completed_turns(history_cache.get(chat_id) or [])
+
+async def _revalidate(chat_id: int, rows: List[HistoryRow]) -> Optional[List[HistoryRow]]:
+    """Дочитывает сообщения новее закэшированного хвоста; обычно запрос по индексу ничего не возвращает."""
+    last_id = rows[-1][0] if rows else 0
+    async with async_session() as session:
+        result = await session.execute(
+            select(Message.id, Message.role, Message.content, Message.token_count)
+            .filter(Message.chat_id == chat_id, Message.id > last_id)
+            .order_by(Message.id.desc())
+            .limit(history_cache.max_messages)
+        )
+        newer = [tuple(row) for row in reversed(result.all())]
+    if not newer:
+        return rows
+    return history_cache.merge(chat_id, newer)
+
+async def _load_rows(chat_id: int) -> List[HistoryRow]:
+    rows = history_cache.get(chat_id)
+    if rows is not None and HISTORY_CACHE_REVALIDATE:
+        # Чат могли вытеснить из кэша, пока шёл запрос, — тогда он загружается заново
+        rows = await _revalidate(chat_id, rows)
+    if rows is None:
+        history_cache.begin_load(chat_id)
+        try:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(Message.id, Message.role, Message.content, Message.token_count)
+                    .filter(Message.chat_id == chat_id)
+                    .order_by(Message.id.desc())
+                    .limit(history_cache.max_messages)
+                )
+                loaded = [tuple(row) for row in reversed(result.all())]
+        except Exception:
+            history_cache.cancel_load(chat_id)
+            raise
+        rows = history_cache.finish_load(chat_id, loaded)
+    return rows
+
+async def load_history(chat_id: int) -> List[HistoryRow]:
+    """История чата для промпта: из кэша, а при промахе — хвост из таблицы messages."""
+    return completed_turns(await _load_rows(chat_id))
+
+async def prompt_cutoff(chat_id: int) -> Optional[int]:
+    """id, начиная с которого сообщения чата и так попадают в промпт: окно истории и текущий вопрос."""
+    rows = await _load_rows(chat_id)
+    window = completed_turns(rows)
+    if window:
+        return window[0][0]
+    cutoff = None
+    for row in reversed(rows):
+        if row[1] != "user":
+            break
+        cutoff = row[0]
+    return cutoff
+
+@event.listens_for(Session, "before_flush")
+def _estimate_message_tokens(session, flush_context, instances):
+    """Оценка длины для сообщений, записанных без подсчёта токенизатором (например, пока он загружается).
+
+    Сам токенизатор здесь не вызывается: flush идёт в цикле событий, а писатели считают токены заранее в потоке.
+    """
+    for obj in session.new:
+        if isinstance(obj, Message) and obj.token_count is None and obj.content:
+            obj.token_count = estimate_tokens(obj.content)
+
+@event.listens_for(Session, "after_flush")
+def _collect_written_messages(session, flush_context):
+    rows = [
+        (obj.chat_id, (obj.id, obj.role, obj.content, obj.token_count))
+        for obj in session.new
+        if isinstance(obj, Message)
+    ]
+    if rows:
+        session.info.setdefault("history_rows", []).extend(rows)
+
+@event.listens_for(Session, "after_commit")
+def _publish_written_messages(session):
+    for chat_id, row in session.info.pop("history_rows", []):
+        history_cache.append(chat_id, row)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_written_messages(session):
+    session.info.pop("history_rows", None)
@@ -0,0 +1,212 @@
+"""Слой HTTP-ответов: сжатие, статика с отпечатками содержимого, ETag и кэш отрендеренных страниц."""
+import hashlib
+import os
+import stat
+import zlib
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs
+
+from fastapi import Request
+from fastapi.responses import HTMLResponse, Response
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него ответы сжимаются только gzip
+    brotli = None
+
+# Ответы меньше порога отдаются без сжатия: выигрыш не окупает заголовки и время на сжатие
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Слабое сравнение ETag с If-None-Match: сжатый ответ остаётся тем же ресурсом."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tag = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == tag for candidate in header.split(","))
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def _compressible(headers: Headers) -> bool:
+    if "content-encoding" in headers:
+        return False
+    content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    # SSE нельзя буферизовать компрессором: токены должны уходить клиенту сразу
+    if content_type == "text/event-stream":
+        return False
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        # Между частями потока компрессор сбрасывается, чтобы клиент получал их без задержки
+        if self.encoding == "br":
+            return self._brotli.process(data) + (self._brotli.finish() if final else self._brotli.flush())
+        return self._gzip.compress(data) + self._gzip.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class _CompressingSend:
+    """Обёртка send одного ответа: решение о сжатии принимается по заголовкам и первой части тела."""
+
+    def __init__(self, send: Send, encoding: str, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self._start: Optional[Message] = None
+        self._compressor: Optional[_Compressor] = None
+
+    async def __call__(self, message: Message):
+        if message["type"] == "http.response.start":
+            self._start = message
+            return
+        if self._start is None:
+            if self._compressor is not None and message["type"] == "http.response.body":
+                more_body = message.get("more_body", False)
+                message = {
+                    "type": "http.response.body",
+                    "body": self._compressor.compress(message.get("body", b""), final=not more_body),
+                    "more_body": more_body,
+                }
+            await self._send(message)
+            return
+
+        start, self._start = self._start, None
+        headers = MutableHeaders(raw=start["headers"])
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if (
+            message["type"] != "http.response.body"
+            or not _compressible(headers)
+            or (not more_body and len(body) < self.minimum_size)
+        ):
+            await self._send(start)
+            await self._send(message)
+            return
+
+        self._compressor = _Compressor(self.encoding)
+        data = self._compressor.compress(body, final=not more_body)
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = "W/" + etag
+        if more_body:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(len(data))
+        await self._send(start)
+        await self._send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+class CompressionMiddleware:
+    """Сжимает текстовые ответы (HTML, JSON, CSS, JS) brotli или gzip — что поддерживает клиент.
+
+    Ответы меньше minimum_size, уже сжатые и потоки SSE идут как есть. Потоковые ответы сжимаются по частям.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = max(1, minimum_size)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.minimum_size))
+
+class StaticAssets(StaticFiles):
+    """/static с отпечатками содержимого.
+
+    url() добавляет к пути ?v=<хэш файла>; ответ на такой адрес кэшируется браузером навсегда (immutable),
+    а при изменении файла меняется и адрес. Без отпечатка или с устаревшим файл отдаётся с no-cache
+    и проверяется по ETag.
+    """
+
+    def __init__(self, directory: str, prefix: str = "/static"):
+        super().__init__(directory=directory)
+        self.prefix = prefix
+        self._fingerprints: Dict[str, str] = {}
+
+    def fingerprint(self, path: str) -> str:
+        path = os.path.normpath(path)
+        fingerprint = self._fingerprints.get(path)
+        if fingerprint is None:
+            full_path, stat_result = self.lookup_path(path)
+            if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+                return ""
+            with open(full_path, "rb") as file:
+                fingerprint = hashlib.sha256(file.read()).hexdigest()[:12]
+            self._fingerprints[path] = fingerprint
+        return fingerprint
+
+    def url(self, path: str) -> str:
+        fingerprint = self.fingerprint(path)
+        url = f"{self.prefix}/{path.lstrip('/')}"
+        return f"{url}?v={fingerprint}" if fingerprint else url
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            version = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("v", [""])[0]
+            if version and version == self.fingerprint(path):
+                response.headers["Cache-Control"] = f"public, max-age={STATIC_IMMUTABLE_MAX_AGE}, immutable"
+            else:
+                response.headers["Cache-Control"] = "no-cache"
+        return response
+
+class PageCache:
+    """Страницы, зависящие только от переданного контекста (не от запроса), рендерятся один раз на процесс.
+
+    Ответ отдаётся с ETag; браузер перепроверяет страницу и получает 304, пока шаблон не изменился.
+    """
+
+    def __init__(self, templates: Jinja2Templates):
+        self.templates = templates
+        self._pages: Dict[tuple, Tuple[bytes, str]] = {}
+
+    def response(self, request: Request, name: str, **context) -> Response:
+        key = (name, tuple(sorted(context.items())))
+        page = self._pages.get(key)
+        if page is None:
+            body = self.templates.get_template(name).render(**context).encode("utf-8")
+            page = self._pages[key] = (body, f'W/"{hashlib.sha256(body).hexdigest()[:16]}"')
+        body, etag = page
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        return HTMLResponse(body, headers=headers)
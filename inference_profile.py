@@ -0,0 +1,133 @@
+import logging
+import os
+from dataclasses import asdict, dataclass
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# auto | cpu | cuda | mps
+INFERENCE_DEVICE = os.getenv("INFERENCE_DEVICE", "auto")
+# auto | fp32 | bf16 | fp16
+INFERENCE_DTYPE = os.getenv("INFERENCE_DTYPE", "auto")
+# none | int8 | auto (int8 для fp32 на CPU); квантизация меняет ответы модели, поэтому включается явно
+INFERENCE_QUANTIZE = os.getenv("INFERENCE_QUANTIZE", "none")
+# 0 — по числу физических ядер
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))
+TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", "1"))
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0") == "1"
+
+TORCH_DTYPES = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+@dataclass
+class InferenceProfile:
+    device: str
+    dtype: str
+    quantize: str
+    num_threads: int
+    interop_threads: int
+    compile: bool
+
+    @property
+    def torch_dtype(self) -> torch.dtype:
+        return TORCH_DTYPES[self.dtype]
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+def cpu_flags() -> set:
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+def cpu_supports_bf16() -> bool:
+    """bf16 на CPU быстрее fp32 только при аппаратной поддержке (AVX512-BF16 или AMX)."""
+    return bool(cpu_flags() & {"avx512_bf16", "amx_bf16"})
+
+def physical_cores() -> int:
+    cores = set()
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            physical_id = None
+            for line in cpuinfo:
+                if line.startswith("physical id"):
+                    physical_id = line.split(":", 1)[1].strip()
+                elif line.startswith("core id"):
+                    cores.add((physical_id, line.split(":", 1)[1].strip()))
+    except OSError:
+        pass
+    available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return max(1, min(len(cores) or available, available))
+
+def detect_device() -> str:
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+def select_profile() -> InferenceProfile:
+    """Выбирает устройство, тип данных, квантизацию и число потоков для текущей машины."""
+    device = detect_device() if INFERENCE_DEVICE == "auto" else INFERENCE_DEVICE
+
+    dtype = INFERENCE_DTYPE
+    if dtype == "auto":
+        if device == "cuda":
+            dtype = "bf16" if torch.cuda.is_bf16_supported() else "fp16"
+        elif device == "mps":
+            dtype = "fp16"
+        else:
+            # fp16 на x86 CPU эмулируется и работает медленнее fp32
+            dtype = "bf16" if cpu_supports_bf16() else "fp32"
+
+    quantize = INFERENCE_QUANTIZE
+    if quantize == "auto":
+        quantize = "int8" if device == "cpu" and dtype == "fp32" else "none"
+        if quantize == "int8":
+            logger.warning("INFERENCE_QUANTIZE=auto: включена динамическая int8-квантизация, ответы могут отличаться от fp32")
+    if quantize == "int8":
+        if device != "cpu":
+            logger.warning(f"Динамическая int8-квантизация доступна только на CPU, для {device} отключена")
+            quantize = "none"
+        elif dtype != "fp32":
+            logger.warning("Динамическая int8-квантизация требует fp32, тип данных изменён на fp32")
+            dtype = "fp32"
+
+    num_threads = TORCH_NUM_THREADS or (physical_cores() if device == "cpu" else torch.get_num_threads())
+    profile = InferenceProfile(
+        device=device,
+        dtype=dtype,
+        quantize=quantize,
+        num_threads=num_threads,
+        interop_threads=TORCH_INTEROP_THREADS,
+        compile=TORCH_COMPILE,
+    )
+    logger.info(f"Профиль инференса: {profile.as_dict()}")
+    return profile
+
+def apply_threads(profile: InferenceProfile):
+    torch.set_num_threads(profile.num_threads)
+    try:
+        torch.set_num_interop_threads(profile.interop_threads)
+    except RuntimeError:
+        # Число inter-op потоков можно задать только до первой параллельной операции
+        logger.warning("Число inter-op потоков уже зафиксировано, оставляем текущее")
+
+def prepare_model(model, profile: InferenceProfile):
+    model.eval()
+    if profile.quantize == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info("Linear-слои модели квантизованы в int8")
+    if profile.compile:
+        model.forward = torch.compile(model.forward, dynamic=True)
+        logger.info("forward модели скомпилирован через torch.compile")
+    return model
@@ -0,0 +1,323 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cancellation import GENERATION_SAVE_PARTIAL, CancelToken, active_generations, use_cancel
+from database import async_session
+from llm import clean_response, get_conversation_chain
+from metrics import log_event
+from models import GenerationJob, Message
+from token_counter import token_counter
+from user_limits import use_owner
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+JOB_CLAIM_BATCH = int(os.getenv("JOB_CLAIM_BATCH", "8"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Выполняемая задача без отметки живости дольше этого срока возвращается в очередь
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Задержка перед повтором упавшей задачи удваивается с каждой попыткой
+JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "5"))
+
+def enqueue_job(db: AsyncSession, chat_id: int, content: str, owner: Optional[str] = None) -> GenerationJob:
+    """Добавляет задачу генерации в текущую транзакцию; она станет видна воркеру после коммита."""
+    job = GenerationJob(chat_id=chat_id, content=content, owner=owner, status="pending", attempts=0)
+    db.add(job)
+    return job
+
+async def cancel_pending_jobs(db: AsyncSession, chat_id: int) -> int:
+    """Отменяет ещё не взятые в работу задачи чата; выполняемые отменяются через active_generations."""
+    result = await db.execute(
+        update(GenerationJob)
+        .where(GenerationJob.chat_id == chat_id, GenerationJob.status == "pending")
+        .values(status="cancelled", error="cancelled", finished_at=datetime.now())
+    )
+    await db.commit()
+    return result.rowcount
+
+class JobWorker:
+    """Асинхронный обработчик очереди generation_jobs.
+
+    Забирает задачи пачками, выполняет не больше concurrency генераций одновременно
+    и сохраняет ответ модели вместе с отметкой о выполнении задачи.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = JOB_WORKER_CONCURRENCY,
+        claim_batch: int = JOB_CLAIM_BATCH,
+        poll_seconds: float = JOB_POLL_SECONDS,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.claim_batch = max(1, claim_batch)
+        self.poll_seconds = poll_seconds
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running = set()
+        # id задач, которые выполняет этот процесс: для них обновляется heartbeat_at
+        self._running_jobs = set()
+        self._next_heartbeat = 0.0
+
+    async def start(self):
+        await self.resume_unfinished()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+        logger.info(f"Обработчик задач генерации запущен: до {self.concurrency} одновременно")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        interrupted = list(self._running_jobs)
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        # Свои прерванные задачи сразу возвращаются в очередь, не дожидаясь истечения аренды
+        if interrupted:
+            try:
+                async with async_session() as session:
+                    await session.execute(
+                        update(GenerationJob)
+                        .where(GenerationJob.id.in_(interrupted), GenerationJob.status == "running")
+                        .values(status="pending", claim_token=None, started_at=None, heartbeat_at=None)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await session.commit()
+            except Exception as e:
+                logger.error(f"Прерванные задачи не возвращены в очередь, их вернёт истечение аренды: {str(e)}")
+        logger.info("Обработчик задач генерации остановлен")
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def resume_unfinished(self):
+        """Возвращает в очередь брошенные задачи — те, чей процесс перестал обновлять heartbeat_at.
+
+        Задачи, которые прямо сейчас выполняет другой живой процесс (несколько воркеров uvicorn,
+        поэтапный перезапуск), не трогаются.
+        """
+        stale_before = datetime.now() - timedelta(seconds=JOB_LEASE_SECONDS)
+        async with async_session() as session:
+            result = await session.execute(
+                update(GenerationJob)
+                .where(
+                    GenerationJob.status == "running",
+                    func.coalesce(GenerationJob.heartbeat_at, GenerationJob.started_at) < stale_before
+                )
+                .values(status="pending", claim_token=None, started_at=None, heartbeat_at=None)
+            )
+            await session.commit()
+        if result.rowcount:
+            logger.info(f"Возобновлено брошенных задач генерации: {result.rowcount}")
+
+    async def _heartbeat(self):
+        if not self._running_jobs:
+            return
+        async with async_session() as session:
+            await session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id.in_(list(self._running_jobs)), GenerationJob.status == "running")
+                .values(heartbeat_at=datetime.now())
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+
+    async def _maintain(self):
+        """Раз в треть срока аренды: отметка живости своих задач и возврат брошенных чужих."""
+        now = asyncio.get_running_loop().time()
+        if now < self._next_heartbeat:
+            return
+        self._next_heartbeat = now + JOB_LEASE_SECONDS / 3
+        try:
+            await self._heartbeat()
+            await self.resume_unfinished()
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания задач генерации: {str(e)}")
+
+    async def _loop(self):
+        while True:
+            await self._maintain()
+            free = self.concurrency - len(self._running)
+            if free > 0:
+                try:
+                    jobs = await self._claim(min(free, self.claim_batch))
+                except Exception as e:
+                    logger.error(f"Ошибка получения задач генерации: {str(e)}")
+                    jobs = []
+                for job in jobs:
+                    task = asyncio.create_task(self._process(job))
+                    self._running.add(task)
+                    task.add_done_callback(self._on_done)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_done(self, task: asyncio.Task):
+        self._running.discard(task)
+        self.notify()
+
+    async def _claim(self, limit: int) -> List[GenerationJob]:
+        """Атомарно помечает до limit ожидающих задач как выполняемые этим процессом."""
+        token = uuid.uuid4().hex
+        now = datetime.now()
+        async with async_session() as session:
+            pending_ids = (
+                select(GenerationJob.id)
+                .where(
+                    GenerationJob.status == "pending",
+                    or_(GenerationJob.retry_at.is_(None), GenerationJob.retry_at <= now)
+                )
+                .order_by(GenerationJob.id)
+                .limit(limit)
+                .scalar_subquery()
+            )
+            await session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id.in_(pending_ids), GenerationJob.status == "pending")
+                .values(
+                    status="running",
+                    claim_token=token,
+                    started_at=now,
+                    heartbeat_at=now,
+                    attempts=GenerationJob.attempts + 1
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            result = await session.execute(
+                select(GenerationJob).where(GenerationJob.claim_token == token).order_by(GenerationJob.id)
+            )
+            return list(result.scalars().all())
+
+    async def _process(self, job: GenerationJob):
+        self._running_jobs.add(job.id)
+        try:
+            await self._run_job(job)
+        finally:
+            self._running_jobs.discard(job.id)
+
+    async def _run_job(self, job: GenerationJob):
+        cancel = CancelToken()
+        try:
+            with active_generations.track(job.chat_id, cancel), use_cancel(cancel), use_owner(job.owner):
+                conversation = get_conversation_chain()
+                log_event(logger, "job_started", job_id=job.id, chat_id=job.chat_id, attempt=job.attempts)
+                response = await conversation.ainvoke(
+                    {"input": job.content},
+                    config={"configurable": {"session_id": str(job.chat_id)}}
+                )
+            response_text = clean_response(response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Задача {job.id}: ошибка генерации (попытка {job.attempts}): {str(e)}")
+            await self._fail(job, str(e))
+            return
+
+        if cancel.cancelled:
+            await self._cancelled(job, cancel.reason, response_text)
+            return
+
+        token_count = await token_counter.acount(response_text)
+        async with async_session() as session:
+            llm_message = Message(content=response_text, role="assistant", chat_id=job.chat_id, token_count=token_count)
+            session.add(llm_message)
+            await session.flush()
+            result = await session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id == job.id, GenerationJob.claim_token == job.claim_token)
+                .values(status="done", result_message_id=llm_message.id, finished_at=datetime.now(), error=None)
+            )
+            if result.rowcount == 0:
+                # Задачу сочли брошенной и отдали другому процессу — второй ответ не сохраняется
+                await session.rollback()
+                logger.warning(f"Задача {job.id} перехвачена другим процессом, ответ не сохранён")
+                return
+            await session.commit()
+        log_event(logger, "job_done", job_id=job.id, chat_id=job.chat_id, response_length=len(response_text))
+
+    async def _cancelled(self, job: GenerationJob, reason: str, partial_text: str):
+        async with async_session() as session:
+            message_id = None
+            if GENERATION_SAVE_PARTIAL and partial_text:
+                partial_message = Message(
+                    content=partial_text,
+                    role="assistant",
+                    chat_id=job.chat_id,
+                    token_count=await token_counter.acount(partial_text)
+                )
+                session.add(partial_message)
+                await session.flush()
+                message_id = partial_message.id
+            result = await session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id == job.id, GenerationJob.claim_token == job.claim_token)
+                .values(status="cancelled", error=reason, result_message_id=message_id, finished_at=datetime.now())
+            )
+            if result.rowcount == 0:
+                await session.rollback()
+                logger.warning(f"Задача {job.id} перехвачена другим процессом, отмена не записана")
+                return
+            await session.commit()
+        log_event(logger, "job_cancelled", sample_rate=1.0, job_id=job.id, chat_id=job.chat_id, reason=reason)
+
+    async def _fail(self, job: GenerationJob, error: str):
+        async with async_session() as session:
+            if job.attempts < JOB_MAX_ATTEMPTS:
+                retry_at = datetime.now() + timedelta(seconds=JOB_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+                result = await session.execute(
+                    update(GenerationJob)
+                    .where(GenerationJob.id == job.id, GenerationJob.claim_token == job.claim_token)
+                    .values(
+                        status="pending",
+                        claim_token=None,
+                        error=error,
+                        started_at=None,
+                        heartbeat_at=None,
+                        retry_at=retry_at
+                    )
+                )
+            else:
+                content = f"Ошибка обработки сообщения моделью: {error}"
+                error_message = Message(
+                    content=content,
+                    role="assistant",
+                    chat_id=job.chat_id,
+                    token_count=await token_counter.acount(content)
+                )
+                session.add(error_message)
+                await session.flush()
+                result = await session.execute(
+                    update(GenerationJob)
+                    .where(GenerationJob.id == job.id, GenerationJob.claim_token == job.claim_token)
+                    .values(
+                        status="failed",
+                        error=error,
+                        result_message_id=error_message.id,
+                        finished_at=datetime.now()
+                    )
+                )
+            if result.rowcount == 0:
+                # Задачей уже владеет другой процесс: ни её статус, ни сообщение об ошибке не записываются
+                await session.rollback()
+                logger.warning(f"Задача {job.id} перехвачена другим процессом, ошибка не записана")
+                return
+            await session.commit()
+        self.notify()
+
+job_worker = JobWorker()
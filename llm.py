@@ -1,107 +1,244 @@
-from langchain_huggingface import HuggingFacePipeline
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+"""Генерация ответов для процесса API: планировщик, пул процессов инференса, кэш ответов и потоковая выдача.
+
+Сама модель (torch, transformers) живёт в модуле generation, а цепочка LangChain — в модуле chain;
+оба импортируются лениво, при первой генерации или в процессе инференса, так что старт API их не ждёт.
+"""
+from typing import AsyncIterator, List, Optional
+from batching import STREAM_DEFAULT_CONCURRENCY, STREAM_MAX_CONCURRENT, GenerationScheduler, StreamGate
+from model_settings import MODEL_NAME
+from cancellation import CancelToken, current_cancel
+from response_cache import create_response_cache, make_cache_key
+from stop_sequences import StopSequenceMatcher, truncate_at_stop
+from user_limits import current_owner
+from workers import create_inference_pool
+import metrics
+import asyncio
 import logging
-import torch
+import os
+import sys
 import time
-from collections import defaultdict
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
-def get_llm():
-    logger.info("Начало загрузки модели...")
+# 0 — сервер начинает принимать запросы сразу, модель загружается в фоне (удобно при --reload)
+MODEL_PRELOAD = os.getenv("MODEL_PRELOAD", "1") == "1"
+WARMUP_PROMPT = "Привет"
+
+GENERATION_KWARGS = {
+    "max_new_tokens": 256,
+    "do_sample": False,
+    "repetition_penalty": 1.1,
+}
+
+class ModelInfo:
+    """Профиль и время загрузки модели, которая обслуживает этот процесс API: своей или процессов пула."""
+
+    def __init__(self):
+        self.profile: Optional[dict] = None
+        self.load_seconds: Optional[float] = None
+        # Время импорта torch/transformers/LangChain, если модель загружена в процессе API
+        self.import_seconds: Optional[float] = None
+
+model_info = ModelInfo()
+
+def load_model():
+    """Загружает модель в этом процессе (при первом вызове) и возвращает модуль generation."""
+    started = time.perf_counter()
+    import generation
+    if model_info.import_seconds is None:
+        model_info.import_seconds = time.perf_counter() - started
+
+    generation.registry.load()
+    if model_info.load_seconds is None:
+        model_info.profile = generation.registry.profile.as_dict()
+        model_info.load_seconds = generation.registry.load_seconds
+    return generation
+
+def generate_batch(prompts: List[str], cancels: Optional[List[CancelToken]] = None) -> List[str]:
+    return load_model().generate_batch(prompts, cancels)
+
+def get_conversation_chain():
+    from chain import get_conversation_chain
+
+    return get_conversation_chain()
+
+async def arender_prompt(session_id: str, content: str) -> str:
+    from chain import arender_prompt
+
+    return await arender_prompt(session_id, content)
+
+def local_model_stats() -> dict:
+    """Статистика кэша префиксов и спекулятивного декодирования, если модель загружена в этом процессе."""
+    generation = sys.modules.get("generation")
+    if generation is None:
+        return {"prefix_cache": None, "speculative": None}
+    return {"prefix_cache": generation.prefix_cache.stats(), "speculative": generation.speculative.stats()}
+
+inference_pool = create_inference_pool()
+if inference_pool is not None:
+    scheduler = GenerationScheduler(inference_pool.generate_batch, max_inflight_batches=inference_pool.workers)
+else:
+    scheduler = GenerationScheduler(generate_batch)
+# Потоковые ответы не проходят через батчи, но ждут своей очереди так же по кругу пользователей
+stream_gate = StreamGate(
+    STREAM_MAX_CONCURRENT or (inference_pool.workers if inference_pool is not None else STREAM_DEFAULT_CONCURRENCY)
+)
+response_cache = create_response_cache()
+
+def is_model_ready() -> bool:
+    if inference_pool is not None:
+        return inference_pool.is_ready
+    return model_info.load_seconds is not None
+
+_loading_task: Optional[asyncio.Task] = None
+
+async def _load_inference():
     try:
-        model_name = "Qwen/Qwen2-1.5B-Instruct"
-        device = "mps" if torch.backends.mps.is_available() else "cpu"
-        logger.info(f"Используемое устройство: {device}")
-        
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16,
-            low_cpu_mem_usage=True,
-            trust_remote_code=True
-        ).to(device)
-        logger.info("Модель загружена успешно")
-        
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        logger.info("Токенизатор загружен")
-        
-        hf_pipeline = pipeline(
-            task="text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            max_new_tokens=256,
-            do_sample=False,
-            repetition_penalty=1.1,
-            pad_token_id=tokenizer.eos_token_id,
-            device=device,
-            return_full_text=False
-        )
-        logger.info("Пайплайн создан")
-        return HuggingFacePipeline(pipeline=hf_pipeline)
+        if inference_pool is not None:
+            inference_pool.start()
+            await inference_pool.wait_ready()
+            model_info.profile = inference_pool.profile
+            model_info.load_seconds = inference_pool.load_seconds
+        else:
+            await asyncio.to_thread(load_model)
     except Exception as e:
-        logger.error(f"Ошибка загрузки модели: {str(e)}")
+        logger.error(f"Ошибка запуска инференса: {str(e)}")
         raise
 
-def get_conversation_chain():
-    logger.info("Создание цепочки разговора...")
+async def start_inference():
+    """Загружает модель в процессе API или запускает пул процессов инференса.
+
+    С MODEL_PRELOAD=1 ждёт готовности модели, иначе загрузка идёт в фоне, а готовность видна в /health/ready.
+    """
+    global _loading_task
+    await scheduler.start()
+    if MODEL_PRELOAD:
+        await _load_inference()
+    else:
+        _loading_task = asyncio.create_task(_load_inference())
+
+async def stop_inference():
+    if _loading_task is not None and not _loading_task.done():
+        _loading_task.cancel()
+    await scheduler.stop()
+    if inference_pool is not None:
+        inference_pool.stop()
+
+def check_capacity():
+    """Отказывает с 503 и Retry-After, если очередь пула процессов инференса заполнена."""
+    if inference_pool is not None:
+        inference_pool.admit(waiting=scheduler.pending + stream_gate.pending)
+
+def model_config() -> dict:
+    """Параметры, от которых зависит текст ответа при одинаковом промпте."""
+    profile = model_info.profile or {}
+    return {
+        "model": MODEL_NAME,
+        "dtype": profile.get("dtype"),
+        "quantize": profile.get("quantize"),
+        **GENERATION_KWARGS
+    }
+
+def response_cache_key(prompt: str) -> str:
+    return make_cache_key(prompt, model_config())
+
+async def acomplete(prompt: str) -> str:
+    """Ответ на готовый промпт через планировщик батчей, с учётом кэша ответов.
+
+    Отмена берётся из current_cancel, владелец для очерёдности планировщика — из current_owner;
+    оборванный отменой ответ в кэш не попадает.
+    """
+    cancel = current_cancel.get() or CancelToken()
+    owner = current_owner.get()
+    if response_cache is None:
+        return await scheduler.submit(prompt, cancel, owner)
+    key = response_cache_key(prompt)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+    response = await scheduler.submit(prompt, cancel, owner)
+    if not cancel.cancelled:
+        response_cache.set(key, response)
+    return response
+
+async def _astream_tokens(prompt_text: str, cache_key, cancel: CancelToken, owner=None) -> AsyncIterator[str]:
     try:
-        llm = get_llm()
-        logger.info("LLM получен, создание промпта...")
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """Ты — Grok, ИИ-ассистент, созданный xAI. Отвечай только на вопрос пользователя, без повторения запроса или системного промпта. Давай точные, краткие и полезные ответы на русском языке. Если в запросе есть некорректные данные, четко укажи все ошибки и предоставь правильную информацию, основываясь на исторических фактах. Проверяй факты и избегай выдумок."""),
-            MessagesPlaceholder(variable_name="history"),
-            ("human", "{input}")
-        ])
-        logger.info("Промпт создан, сборка цепочки...")
-        chain = prompt | llm
-        
-        session_histories = defaultdict(ChatMessageHistory)
-
-        def get_session_history(session_id: str) -> BaseChatMessageHistory:
-            history = session_histories[session_id]
-            if len(history.messages) > 8:
-                history.messages = history.messages[-8:]
-            return history
-        
-        chain_with_history = RunnableWithMessageHistory(
-            chain,
-            get_session_history,
-            input_messages_key="input",
-            history_messages_key="history"
-        )
-        logger.info("Цепочка разговора создана")
-        return chain_with_history
-    except Exception as e:
-        logger.error(f"Ошибка создания цепочки: {str(e)}")
+        async with stream_gate.slot(owner):
+            if cancel.cancelled:
+                return
+            if inference_pool is not None:
+                async for chunk in inference_pool.stream(prompt_text, cache_key, cancel):
+                    yield chunk
+                return
+            generation = await asyncio.to_thread(load_model)
+            tokens = generation.stream_generate(prompt_text, cache_key, cancel)
+            while True:
+                chunk = await asyncio.to_thread(next, tokens, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        # Читатель ушёл (например, клиент закрыл соединение) — модель не должна генерировать впустую
+        cancel.cancel("disconnect")
         raise
 
+async def astream_reply(
+    session_id: str, content: str, cancel: Optional[CancelToken] = None, owner=None
+) -> AsyncIterator[str]:
+    """Асинхронно отдаёт токены ответа по мере генерации; после отмены поток заканчивается досрочно.
+
+    Генерация начинается, когда stream_gate пропустит поток; owner (по умолчанию из current_owner) — владелец
+    для очерёдности.
+
+    Части проходят через StopSequenceMatcher: хвост, похожий на начало метки роли, придерживается,
+    а с появлением метки поток обрывается, так что выдуманная следующая реплика клиенту не уходит.
+    """
+    cancel = cancel or CancelToken()
+    owner = owner if owner is not None else current_owner.get()
+    prompt_text = await arender_prompt(session_id, content)
+    key = response_cache_key(prompt_text) if response_cache is not None else None
+    if key is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+    chunks = []
+    matcher = StopSequenceMatcher()
+    started = time.perf_counter()
+    async for chunk in _astream_tokens(prompt_text, f"chat:{session_id}", cancel, owner):
+        if matcher.stopped:
+            # Генерация на стороне модели останавливается на том же токене, остаток только дочитывается
+            continue
+        text = matcher.feed(chunk)
+        if not text:
+            continue
+        if not chunks:
+            metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started)
+        chunks.append(text)
+        yield text
+    tail = matcher.finish()
+    if tail:
+        chunks.append(tail)
+        yield tail
+    if key is not None and not cancel.cancelled:
+        response_cache.set(key, "".join(chunks))
+
 def clean_response(response):
-    """Очистка ответа от системного промпта, меток и лишнего текста."""
+    """Очистка ответа от меток ролей и выдуманных следующих реплик — тем же правилом, что и поток."""
     if not isinstance(response, str):
         response = str(response)
-    
-    markers = ["System:", "Human:", "Assistant:"]
-    cleaned_response = response
-    for marker in markers:
-        if marker in cleaned_response:
-            parts = cleaned_response.split(marker)
-            cleaned_response = parts[-1]
-    
-    cleaned_response = cleaned_response.strip()
-    
+
+    cleaned_response = truncate_at_stop(response).strip()
+
     if "Проверь следующий текст" in cleaned_response:
         cleaned_response = cleaned_response.split("Проверь следующий текст")[-1].strip()
-    
+
     return cleaned_response
 
 if __name__ == "__main__":
     try:
-        logger.info(f"MPS доступен: {torch.backends.mps.is_available()}")
         chain = get_conversation_chain()
         start_time = time.time()
         response = chain.invoke(
@@ -113,7 +250,7 @@ if __name__ == "__main__":
                     "In 2012 Khrushchev took office again seeking reëlection within Vladimir Lenin Center..."
                 )
             },
-            config={"configurable": {"session_id": "test_session"}}
+            config={"configurable": {"session_id": "0"}}
         )
         end_time = time.time()
         cleaned_response = clean_response(response)
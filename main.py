@@ -1,63 +1,195 @@
-from typing import List, Optional
-from fastapi import Depends, FastAPI, Request, HTTPException, BackgroundTasks, Form, Response
-from fastapi.responses import HTMLResponse, RedirectResponse
+import time
+# Отсчёт фазы импорта модулей приложения для отчёта о старте
+_import_started = time.perf_counter()
+from typing import Callable, List, Optional
+from fastapi import Depends, FastAPI, Request, HTTPException, Form, Response, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from database import get_async_session, init_db
 from contextlib import asynccontextmanager
-from llm import get_conversation_chain, clean_response
-from models import Chat, Message, User, RefreshToken
-from schemas import MessageCreate, MessageResponse
+from llm import (
+    get_conversation_chain, clean_response, model_info, astream_reply, scheduler, stream_gate, local_model_stats,
+    response_cache,
+    inference_pool, is_model_ready, start_inference, stop_inference, check_capacity
+)
+from history import history_cache
+from models import Chat, Message, User, GenerationJob
+from schemas import MessageCreate, MessageResponse, JobResponse
+from jobs import cancel_pending_jobs, enqueue_job, job_worker
+from cancellation import GENERATION_SAVE_PARTIAL, CancelToken, active_generations, use_cancel
+from message_writer import message_writer
+from token_counter import token_counter
+from memory import long_term_memory
+from http_cache import CompressionMiddleware, PageCache, StaticAssets, etag_matches
+from refresh_tokens import refresh_tokens
+from user_limits import use_owner, user_limiter
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func
 from sqlalchemy.future import select
-from auth import hash_password, verify_password, create_access_token, create_refresh_token, verify_token
-from datetime import datetime, timedelta
+from auth import ahash_password, averify_password, create_access_token, verify_token_cached, password_pool, token_cache
+import asyncio
+import json
 import logging
+import os
+import metrics
+from metrics import log_event
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
+# Длительность фаз старта в секундах: импорт модулей, проверка схемы БД, запуск инференса
+startup_report = {"import": time.perf_counter() - _import_started}
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    phase_started = time.perf_counter()
     await init_db()
+    startup_report["db"] = time.perf_counter() - phase_started
+    phase_started = time.perf_counter()
+    # С MODEL_PRELOAD=1 модель загружается и прогревается до того, как сервер начнёт принимать запросы
+    await start_inference()
+    startup_report["model"] = time.perf_counter() - phase_started
+    if model_info.import_seconds is not None:
+        startup_report["ml_import"] = model_info.import_seconds
+    await token_counter.start()
+    await long_term_memory.start()
+    await message_writer.start()
+    await job_worker.start()
+    await refresh_tokens.start()
+    for phase, seconds in startup_report.items():
+        metrics.STARTUP_SECONDS.set(seconds, phase=phase)
+    logger.info("Старт: " + ", ".join(f"{phase} {seconds:.2f} с" for phase, seconds in startup_report.items()))
     yield
+    await refresh_tokens.stop()
+    await job_worker.stop()
+    await message_writer.stop()
+    await long_term_memory.stop()
+    await stop_inference()
+    password_pool.shutdown()
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+static_assets = StaticAssets(directory="static")
+app.mount("/static", static_assets, name="static")
 
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["static_url"] = static_assets.url
+# Страницы без данных пользователя рендерятся один раз
+pages = PageCache(templates)
+
+MESSAGES_PAGE_LIMIT = 100
+MESSAGES_PAGE_MAX = 500
+DISCONNECT_POLL_SECONDS = 0.5
+
+# Чаты, для которых сейчас идёт потоковая генерация
+streaming_chats = set()
+
+metrics.gauge("generation_scheduler_pending", "Промпты в очереди планировщика генерации", lambda: scheduler.pending)
+metrics.gauge(
+    "generation_scheduler_pending_users", "Пользователи с промптами в очереди планировщика",
+    lambda: scheduler.pending_owners
+)
+metrics.gauge(
+    "inference_pool_queued", "Промпты в очереди пула инференса",
+    lambda: inference_pool.queued if inference_pool is not None else 0
+)
+metrics.gauge("generation_streams_active", "Активные потоковые генерации", lambda: len(streaming_chats))
+metrics.gauge("generation_streams_waiting", "Потоки в очереди допуска к генерации", lambda: stream_gate.pending)
+metrics.gauge("generation_jobs_running", "Выполняемые задачи генерации", lambda: len(job_worker._running))
+
+class RequestLatencyMiddleware:
+    """Время запроса до отправки последней части тела, а не до заголовков.
+
+    @app.middleware("http") получает ответ, как только отправлены заголовки, и для SSE мерил бы
+    только время до начала потока. Здесь замер заканчивается, когда приложение дописало ответ
+    или клиент отключился.
+    """
+
+    def __init__(self, app):
+        self.app = app
 
-async def get_current_user(request: Request, db: AsyncSession = Depends(get_async_session)) -> Optional[dict]:
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Шаблон маршрута, а не сам путь, чтобы id чатов не плодили ряды метрики
+            route = scope.get("route")
+            metrics.REQUEST_LATENCY.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=str(status_code)
+            )
+
+app.add_middleware(RequestLatencyMiddleware)
+
+async def get_current_user(request: Request) -> Optional[dict]:
     token = request.cookies.get("access_token")
     if not token:
         logger.debug("Токен отсутствует в cookie")
         return None
     try:
-        payload = verify_token(token)
+        payload = verify_token_cached(token)
         logger.debug(f"Токен проверен, пользователь: {payload.get('sub')}")
         return payload
     except HTTPException:
         logger.warning("Недействительный токен")
         return None
 
+@app.get('/health/ready')
+async def readiness():
+    if not is_model_ready():
+        return JSONResponse({"status": "loading"}, status_code=503, headers={"Retry-After": "5"})
+    return {"status": "ready", "model_load_seconds": model_info.load_seconds, "startup": startup_report}
+
+@app.get('/stats/generation')
+async def generation_stats():
+    return {
+        "window_ms": scheduler.window_seconds * 1000,
+        "max_batch_size": scheduler.max_batch_size,
+        "pending": scheduler.pending,
+        "pending_users": scheduler.pending_owners,
+        "streams": stream_gate.stats(),
+        "user_limits": user_limiter.stats(),
+        "history_cache": history_cache.stats(),
+        **local_model_stats(),
+        "response_cache": response_cache.stats() if response_cache else None,
+        "message_writer": message_writer.stats(),
+        "memory": long_term_memory.stats(),
+        **scheduler.stats.snapshot()
+    }
+
+@app.get('/metrics')
+async def prometheus_metrics():
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get('/stats/workers')
+async def worker_stats():
+    if inference_pool is None:
+        return {"workers": [], "mode": "in-process"}
+    return {"mode": "pool", **inference_pool.health()}
+
 @app.get('/', response_class=HTMLResponse)
 async def index_page(request: Request, current_user: Optional[dict] = Depends(get_current_user)):
-    return templates.TemplateResponse(
-        'index.html',
-        {
-            'request': request,
-            'is_authenticated': bool(current_user),
-            'show_search_block': 'true'
-        }
-    )
+    # От пользователя страница зависит только признаком входа, поэтому вариантов всего два
+    return pages.response(request, 'index.html', is_authenticated=bool(current_user), show_search_block='true')
 
 @app.get('/login', response_class=HTMLResponse)
 async def login_page(request: Request):
-    return templates.TemplateResponse(
-        'login.html',
-        {'request': request}
-    )
+    return pages.response(request, 'login.html')
 
 @app.post('/login')
 async def login(
@@ -72,7 +204,7 @@ async def login(
     result = await db.execute(select(User).filter(User.email == email))
     user = result.scalars().first()
     
-    if not user or not verify_password(password, user.hashed_password):
+    if not user or not await averify_password(password, user.hashed_password):
         logger.warning(f"Неудачная попытка входа: {email}")
         return templates.TemplateResponse(
             'login.html',
@@ -81,16 +213,7 @@ async def login(
         )
     
     access_token = create_access_token(data={"sub": user.email})
-    refresh_token = create_refresh_token()
-    
-    # Сохраняем refresh-токен в базе данных
-    refresh_token_expires = datetime.utcnow() + timedelta(days=7)
-    db_refresh_token = RefreshToken(
-        token=refresh_token,
-        user_id=user.id,
-        expires_at=refresh_token_expires
-    )
-    db.add(db_refresh_token)
+    refresh_token = await refresh_tokens.issue(db, user.id)
     await db.commit()
     
     response = RedirectResponse(url='/', status_code=303)
@@ -115,10 +238,7 @@ async def login(
 
 @app.get('/register', response_class=HTMLResponse)
 async def register_page(request: Request):
-    return templates.TemplateResponse(
-        'register.html',
-        {'request': request}
-    )
+    return pages.response(request, 'register.html')
 
 @app.post('/register')
 async def register(
@@ -140,29 +260,19 @@ async def register(
             status_code=400
         )
     
-    hashed_password = hash_password(password)
+    hashed_password = await ahash_password(password)
     new_user = User(
         email=email,
         hashed_password=hashed_password
     )
     db.add(new_user)
     try:
-        await db.commit()
-        await db.refresh(new_user)
-        logger.info(f"Пользователь зарегистрирован: {email}")
-        
+        # Пользователь и его refresh-токен сохраняются одной транзакцией
+        await db.flush()
         access_token = create_access_token(data={"sub": new_user.email})
-        refresh_token = create_refresh_token()
-        
-        # Сохраняем refresh-токен в базе данных
-        refresh_token_expires = datetime.utcnow() + timedelta(days=7)
-        db_refresh_token = RefreshToken(
-            token=refresh_token,
-            user_id=new_user.id,
-            expires_at=refresh_token_expires
-        )
-        db.add(db_refresh_token)
+        refresh_token = await refresh_tokens.issue(db, new_user.id)
         await db.commit()
+        logger.info(f"Пользователь зарегистрирован: {email}")
         
         response = RedirectResponse(url='/', status_code=303)
         response.set_cookie(
@@ -197,24 +307,11 @@ async def refresh_token(request: Request, db: AsyncSession = Depends(get_async_s
     if not refresh_token:
         raise HTTPException(status_code=401, detail="Refresh-токен отсутствует")
     
-    result = await db.execute(
-        select(RefreshToken).filter(
-            RefreshToken.token == refresh_token,
-            RefreshToken.expires_at > datetime.utcnow()
-        )
-    )
-    db_refresh_token = result.scalars().first()
-    
-    if not db_refresh_token:
-        raise HTTPException(status_code=401, detail="Недействительный или истёкший refresh-токен")
-    
-    result = await db.execute(select(User).filter(User.id == db_refresh_token.user_id))
-    user = result.scalars().first()
-    
+    user = await refresh_tokens.validate(db, refresh_token)
     if not user:
-        raise HTTPException(status_code=401, detail="Пользователь не найден")
+        raise HTTPException(status_code=401, detail="Недействительный или истёкший refresh-токен")
     
-    access_token = create_access_token(data={"sub": user.email})
+    access_token = create_access_token(data={"sub": user["sub"]})
     response = Response()
     response.set_cookie(
         key="access_token",
@@ -230,11 +327,10 @@ async def refresh_token(request: Request, db: AsyncSession = Depends(get_async_s
 async def logout(request: Request, db: AsyncSession = Depends(get_async_session)):
     refresh_token = request.cookies.get("refresh_token")
     if refresh_token:
-        result = await db.execute(select(RefreshToken).filter(RefreshToken.token == refresh_token))
-        db_refresh_token = result.scalars().first()
-        if db_refresh_token:
-            await db.delete(db_refresh_token)
-            await db.commit()
+        await refresh_tokens.revoke(db, refresh_token)
+    access_token = request.cookies.get("access_token")
+    if access_token:
+        token_cache.discard(access_token)
     response = RedirectResponse(url='/', status_code=303)
     response.delete_cookie(key="access_token")
     response.delete_cookie(key="refresh_token")
@@ -257,111 +353,315 @@ async def chat_page(request: Request, chat_id: int, db: AsyncSession = Depends(g
         }
     )
 
+async def admit_generation(db: AsyncSession, current_user: dict) -> str:
+    """Допускает генерацию пользователя или отказывает с 429; допущенную нужно завершить user_limiter.release()."""
+    owner = current_user["sub"]
+    queued = 0
+    if user_limiter.max_concurrent > 0:
+        result = await db.execute(
+            select(func.count(GenerationJob.id)).filter(
+                GenerationJob.owner == owner,
+                GenerationJob.status.in_(("pending", "running"))
+            )
+        )
+        queued = result.scalar()
+    user_limiter.acquire(owner, queued)
+    return owner
+
 @app.post('/api/chat')
 async def create_chat(
     message: MessageCreate,
-    background_tasks: BackgroundTasks,
+    generate: bool = True,
     db: AsyncSession = Depends(get_async_session),
     current_user: Optional[dict] = Depends(get_current_user)
 ):
     if not current_user:
         raise HTTPException(status_code=401, detail="Требуется авторизация")
+    owner = None
+    if generate:
+        check_capacity()
+        owner = await admit_generation(db, current_user)
     try:
-        logger.info("Создание нового чата")
+        # Чат, первое сообщение и задача генерации сохраняются одной транзакцией
         new_chat = Chat()
         db.add(new_chat)
-        await db.commit()
-        await db.refresh(new_chat)
-        logger.info(f"Чат создан, ID: {new_chat.id}")
+        await db.flush()
 
-        user_message = Message(content=message.content, role="user", chat_id=new_chat.id)
-        db.add(user_message)
+        token_count = await token_counter.acount(message.content)
+        db.add(Message(content=message.content, role="user", chat_id=new_chat.id, token_count=token_count))
+        # Без generate ответ модели получается через /api/chat/{chat_id}/stream
+        job = enqueue_job(db, new_chat.id, message.content, owner) if generate else None
         await db.commit()
-        await db.refresh(user_message)
-        logger.info(f"Сообщение пользователя сохранено: {message.content}")
-
-        async def process_model_response(chat_id: int, content: str):
-            try:
-                conversation = get_conversation_chain()
-                logger.info(f"Вызов модели для чата {chat_id} с сообщением: {content}")
-                response = await conversation.ainvoke(
-                    {"input": content},
-                    config={"configurable": {"session_id": str(chat_id)}}
-                )
-                logger.info(f"Сырой ответ модели: {response}")
-                response_text = clean_response(response)
-                logger.info(f"Обработанный ответ: {response_text}")
-
-                llm_message = Message(content=response_text, role="assistant", chat_id=chat_id)
-                db.add(llm_message)
-                await db.commit()
-                await db.refresh(llm_message)
-                logger.info("Ответ модели сохранён")
-            except Exception as e:
-                logger.error(f"Ошибка при вызове модели: {str(e)}")
-                error_message = Message(
-                    content=f"Ошибка обработки сообщения моделью: {str(e)}",
-                    role="assistant",
-                    chat_id=chat_id
-                )
-                db.add(error_message)
-                await db.commit()
-
-        background_tasks.add_task(process_model_response, new_chat.id, message.content)
+        log_event(logger, "chat_created", chat_id=new_chat.id, content_length=len(message.content))
 
+        if job is not None:
+            job_worker.notify()
+            return {"chat_id": new_chat.id, "job_id": job.id}
         return {"chat_id": new_chat.id}
     except Exception as e:
         await db.rollback()
         logger.error(f"Ошибка создания чата: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка создания чата: {str(e)}")
+    finally:
+        if owner is not None:
+            # Дальше задача учитывается своей строкой в generation_jobs
+            user_limiter.release(owner)
+
+async def cancel_on_disconnect(request: Request, cancel: CancelToken):
+    """Отменяет генерацию, если клиент закрыл соединение, не дождавшись ответа."""
+    while not cancel.cancelled:
+        if await request.is_disconnected():
+            cancel.cancel("disconnect")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+def cancelled_error(cancel: CancelToken) -> HTTPException:
+    if cancel.reason == "deadline":
+        return HTTPException(status_code=504, detail="Генерация ответа не уложилась в отведённое время")
+    return HTTPException(status_code=409, detail="Генерация ответа отменена")
 
 @app.post('/api/chat/{chat_id}/message', response_model=MessageResponse)
-async def add_message(chat_id: int, message: MessageCreate, db: AsyncSession = Depends(get_async_session), current_user: Optional[dict] = Depends(get_current_user)):
+async def add_message(request: Request, chat_id: int, message: MessageCreate, generate: bool = True, db: AsyncSession = Depends(get_async_session), current_user: Optional[dict] = Depends(get_current_user)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Требуется авторизация")
+    owner = None
+    if generate:
+        check_capacity()
+        owner = await admit_generation(db, current_user)
     try:
-        logger.info(f"Получен запрос на добавление сообщения в чат {chat_id}: {message.content}")
+        log_event(logger, "message_received", chat_id=chat_id, content_length=len(message.content), generate=generate)
         result = await db.execute(select(Chat).filter(Chat.id == chat_id))
         chat = result.scalars().first()
         if not chat:
             raise HTTPException(status_code=404, detail="Чат не найден")
 
-        user_message = Message(content=message.content, role="user", chat_id=chat_id)
-        db.add(user_message)
-        await db.commit()
-        await db.refresh(user_message)
+        user_message = await message_writer.write(chat_id, "user", message.content)
 
-        conversation = get_conversation_chain()
-        logger.info(f"Цепочка разговора создана, вызов ainvoke с: {message.content}")
-        response = await conversation.ainvoke(
-            {"input": message.content},
-            config={"configurable": {"session_id": str(chat_id)}}
-        )
-        logger.info(f"Сырой ответ от модели: {response}")
+        if not generate:
+            return MessageResponse(
+                id=user_message.id,
+                content=user_message.content,
+                role=user_message.role,
+                timestamp=user_message.timestamp
+            )
+
+        cancel = CancelToken()
+        watcher = asyncio.create_task(cancel_on_disconnect(request, cancel))
+        try:
+            with active_generations.track(chat_id, cancel), use_cancel(cancel), use_owner(owner):
+                conversation = get_conversation_chain()
+                response = await conversation.ainvoke(
+                    {"input": message.content},
+                    config={"configurable": {"session_id": str(chat_id)}}
+                )
+        finally:
+            watcher.cancel()
+        logger.debug(f"Сырой ответ от модели для чата {chat_id}: {response}")
         response_text = clean_response(response)
-        logger.info(f"Обработанный ответ: {response_text}")
+        if cancel.cancelled:
+            log_event(
+                logger, "generation_cancelled", sample_rate=1.0,
+                chat_id=chat_id, reason=cancel.reason, response_length=len(response_text)
+            )
+            # Отключившемуся клиенту ответ уже не нужен, но часть ответа может остаться в чате
+            if not (GENERATION_SAVE_PARTIAL and response_text):
+                raise cancelled_error(cancel)
+        else:
+            log_event(logger, "reply_generated", chat_id=chat_id, response_length=len(response_text))
 
-        llm_message = Message(content=response_text, role="assistant", chat_id=chat_id)
-        db.add(llm_message)
-        await db.commit()
-        await db.refresh(llm_message)
+        llm_message = await message_writer.write(chat_id, "assistant", response_text)
 
         return MessageResponse(
+            id=llm_message.id,
             content=llm_message.content,
             role=llm_message.role,
             timestamp=llm_message.timestamp
         )
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
         await db.rollback()
         logger.error(f"Ошибка: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка добавления сообщения: {str(e)}")
+    finally:
+        if owner is not None:
+            user_limiter.release(owner)
+
+@app.get('/api/jobs/{job_id}', response_model=JobResponse)
+async def get_job(job_id: int, db: AsyncSession = Depends(get_async_session), current_user: Optional[dict] = Depends(get_current_user)):
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
+    result = await db.execute(select(GenerationJob).filter(GenerationJob.id == job_id))
+    job = result.scalars().first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return job
+
+class GuardedStreamingResponse(StreamingResponse):
+    """StreamingResponse, который вызывает on_close, когда ответ отправлен или прерван, —
+    даже если клиент ушёл раньше, чем начал читаться генератор тела."""
+
+    def __init__(self, content, on_close: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get('/api/chat/{chat_id}/stream')
+async def stream_chat(chat_id: int, db: AsyncSession = Depends(get_async_session), current_user: Optional[dict] = Depends(get_current_user)):
+    """Потоковый ответ модели (Server-Sent Events) на последнее сообщение пользователя в чате."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
+    if chat_id in streaming_chats:
+        raise HTTPException(status_code=409, detail="Ответ для этого чата уже генерируется")
+    # Чат занимается до первого await, чтобы два одновременных запроса не начали две генерации
+    streaming_chats.add(chat_id)
+    owner = None
+    released = False
+
+    def release():
+        nonlocal released
+        if released:
+            return
+        released = True
+        streaming_chats.discard(chat_id)
+        if owner is not None:
+            user_limiter.release(owner)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    try:
+        result = await db.execute(
+            select(Message).filter(Message.chat_id == chat_id).order_by(Message.id.desc()).limit(1)
+        )
+        last_message = result.scalars().first()
+
+        result = await db.execute(
+            select(GenerationJob.id).filter(
+                GenerationJob.chat_id == chat_id,
+                GenerationJob.status.in_(("pending", "running"))
+            ).limit(1)
+        )
+        if result.scalar() is not None:
+            raise HTTPException(status_code=409, detail="Ответ для этого чата уже генерируется")
+
+        if not last_message or last_message.role != "user":
+            # Отвечать не на что: клиент мог переподключиться после завершения генерации
+            release()
+            return StreamingResponse(iter([sse_event("done", {})]), media_type="text/event-stream", headers=headers)
+
+        check_capacity()
+        owner = await admit_generation(db, current_user)
+        content = last_message.content
+        cancel = CancelToken()
+    except BaseException:
+        release()
+        raise
+
+    async def event_stream():
+        chunks = []
+        try:
+            with active_generations.track(chat_id, cancel):
+                try:
+                    async for chunk in astream_reply(str(chat_id), content, cancel, owner=owner):
+                        chunks.append(chunk)
+                        yield sse_event("token", {"text": chunk})
+                    response_text = clean_response("".join(chunks))
+                    failed = False
+                except Exception as e:
+                    logger.error(f"Ошибка при потоковой генерации для чата {chat_id}: {str(e)}")
+                    response_text = f"Ошибка обработки сообщения моделью: {str(e)}"
+                    failed = True
+
+            event = "fail" if failed else "done"
+            if cancel.cancelled and not failed:
+                event = "cancelled"
+                log_event(
+                    logger, "generation_cancelled", sample_rate=1.0,
+                    chat_id=chat_id, reason=cancel.reason, response_length=len(response_text)
+                )
+                if not (GENERATION_SAVE_PARTIAL and response_text):
+                    yield sse_event(event, {"reason": cancel.reason})
+                    return
+
+            # Сессия запроса к этому моменту может быть уже закрыта; запись идёт через свою
+            llm_message = await message_writer.write(chat_id, "assistant", response_text)
+            logger.info(f"Потоковый ответ для чата {chat_id} сохранён")
+
+            payload = {
+                "id": llm_message.id,
+                "content": llm_message.content,
+                "role": llm_message.role,
+                "timestamp": llm_message.timestamp.isoformat()
+            }
+            yield sse_event(event, payload)
+        except (asyncio.CancelledError, GeneratorExit):
+            # Клиент закрыл соединение: генерация уже отменена, ждать записи здесь нельзя
+            cancel.cancel("disconnect")
+            if GENERATION_SAVE_PARTIAL and chunks:
+                message_writer.write_nowait(chat_id, "assistant", clean_response("".join(chunks)))
+            raise
+        finally:
+            release()
+
+    # release() вызывается и после отправки ответа: тело может так и не начать читаться
+    return GuardedStreamingResponse(event_stream(), on_close=release, media_type="text/event-stream", headers=headers)
+
+@app.delete('/api/chat/{chat_id}/generation')
+async def cancel_generation(chat_id: int, db: AsyncSession = Depends(get_async_session), current_user: Optional[dict] = Depends(get_current_user)):
+    """Отменяет идущую генерацию ответа в чате и ещё не начатые задачи генерации."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
+    running = active_generations.cancel(chat_id)
+    pending = await cancel_pending_jobs(db, chat_id)
+    logger.info(f"Отмена генерации для чата {chat_id}: выполняемых {running}, ожидающих задач {pending}")
+    return {"cancelled": running + pending}
 
 @app.get('/api/chat/{chat_id}/messages', response_model=List[MessageResponse])
-async def get_chat_messages(chat_id: int, db: AsyncSession = Depends(get_async_session), current_user: Optional[dict] = Depends(get_current_user)):
+async def get_chat_messages(
+    request: Request,
+    response: Response,
+    chat_id: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(MESSAGES_PAGE_LIMIT, ge=1, le=MESSAGES_PAGE_MAX),
+    db: AsyncSession = Depends(get_async_session),
+    current_user: Optional[dict] = Depends(get_current_user)
+):
+    """Сообщения чата по возрастанию id.
+
+    С after_id отдаются сообщения новее курсора, иначе — последняя страница (до before_id, если он задан).
+    """
     if not current_user:
         raise HTTPException(status_code=401, detail="Требуется авторизация")
-    result = await db.execute(select(Message).filter(Message.chat_id == chat_id).order_by(Message.timestamp))
-    messages = result.scalars().all()
+
+    # Сообщения только добавляются, поэтому состояние чата определяется последним id
+    result = await db.execute(select(func.max(Message.id)).filter(Message.chat_id == chat_id))
+    last_id = result.scalar() or 0
+    etag = f'W/"{chat_id}-{last_id}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    query = select(Message).filter(Message.chat_id == chat_id)
+    if after_id is not None:
+        query = query.filter(Message.id > after_id).order_by(Message.id).limit(limit)
+        result = await db.execute(query)
+        messages = result.scalars().all()
+    else:
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        result = await db.execute(query.order_by(Message.id.desc()).limit(limit))
+        messages = list(reversed(result.scalars().all()))
+
     return messages
 
 if __name__ == '__main__':
@@ -0,0 +1,344 @@
+"""Долговременная память чатов: поиск по старым сообщениям, которые уже не помещаются в окно истории.
+
+Сообщения эмбеддятся небольшой локальной моделью в фоне, пачками; векторы лежат в NumPy-индексе на чат —
+в памяти процесса или в файлах на диске, отображаемых через memmap. numpy, torch и transformers импортируются
+только при включённой памяти, так что без MEMORY_EMBEDDING_MODEL они не нужны.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from database import async_session
+from history import HistoryRow, row_tokens
+from models import Message
+
+logger = logging.getLogger(__name__)
+
+# Пустое значение — долговременная память выключена
+# (подходит, например, sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2)
+MEMORY_EMBEDDING_MODEL = os.getenv("MEMORY_EMBEDDING_MODEL", "")
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+# Ниже этой косинусной близости сообщение считается не относящимся к вопросу
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.35"))
+# Бюджет токенов найденных сообщений в промпте
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "256"))
+# Каталог индексов на диске; пусто — индексы в памяти и после перезапуска строятся заново
+MEMORY_DIR = os.getenv("MEMORY_DIR", "")
+MEMORY_MAX_CHATS = int(os.getenv("MEMORY_MAX_CHATS", "1024"))
+MEMORY_BATCH_SIZE = int(os.getenv("MEMORY_BATCH_SIZE", "32"))
+MEMORY_BATCH_WINDOW_MS = float(os.getenv("MEMORY_BATCH_WINDOW_MS", "200"))
+MEMORY_MAX_TEXT_TOKENS = 256
+
+class Embedder:
+    """Модель-энкодер: усреднённый по токенам вектор, нормированный для косинусной близости."""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.model = None
+        self.tokenizer = None
+        self.dim = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.model is not None:
+                return
+            started = time.perf_counter()
+            from transformers import AutoModel, AutoTokenizer
+
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self.model = AutoModel.from_pretrained(self.model_name).eval()
+            self.dim = self.model.config.hidden_size
+            logger.info(f"Модель эмбеддингов {self.model_name} загружена за {time.perf_counter() - started:.2f} секунд")
+
+    def embed(self, texts: Sequence[str]) -> "np.ndarray":
+        import torch
+
+        inputs = self.tokenizer(
+            list(texts), padding=True, truncation=True, max_length=MEMORY_MAX_TEXT_TOKENS, return_tensors="pt"
+        )
+        with torch.inference_mode():
+            hidden = self.model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        vectors = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        return torch.nn.functional.normalize(vectors, dim=1).float().numpy()
+
+class ChatIndex:
+    """Векторы сообщений одного чата и их id.
+
+    С path векторы дописываются в файлы <path>.vec и <path>.ids и читаются через np.memmap:
+    в памяти процесса остаются только страницы, нужные поиску. Поиск — полный перебор,
+    для одного чата это одно матричное умножение.
+    """
+
+    def __init__(self, dim: int, path: Optional[str] = None):
+        import numpy as np
+
+        self.dim = dim
+        self.path = path
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path + ".ids") and os.path.exists(path + ".vec"):
+            self._map(repair=True)
+
+    def _map(self, repair: bool = False):
+        count = min(os.path.getsize(self.path + ".ids") // 8, os.path.getsize(self.path + ".vec") // (4 * self.dim))
+        if repair:
+            # Запись, оборванная на середине, отбрасывается, чтобы файлы не разошлись при следующей дозаписи
+            os.truncate(self.path + ".ids", count * 8)
+            os.truncate(self.path + ".vec", count * 4 * self.dim)
+        if count == 0:
+            return
+        import numpy as np
+
+        self.ids = np.memmap(self.path + ".ids", dtype=np.int64, mode="r", shape=(count,))
+        self.vectors = np.memmap(self.path + ".vec", dtype=np.float32, mode="r", shape=(count, self.dim))
+
+    def add(self, ids: "np.ndarray", vectors: "np.ndarray"):
+        import numpy as np
+
+        with self._lock:
+            fresh = ~np.isin(ids, self.ids)
+            ids, vectors = ids[fresh], vectors[fresh]
+            if not len(ids):
+                return
+            if self.path is None:
+                self.ids = np.concatenate([self.ids, ids])
+                self.vectors = np.concatenate([self.vectors, vectors])
+                return
+            with open(self.path + ".vec", "ab") as file:
+                file.write(vectors.astype(np.float32).tobytes())
+            with open(self.path + ".ids", "ab") as file:
+                file.write(ids.astype(np.int64).tobytes())
+            self._map()
+
+    def search(self, query: "np.ndarray", k: int, before_id: Optional[int], min_score: float) -> List[Tuple[int, float]]:
+        """До k самых близких к query сообщений с id меньше before_id, по убыванию близости."""
+        import numpy as np
+
+        with self._lock:
+            ids, vectors = self.ids, self.vectors
+        if not len(ids) or k <= 0:
+            return []
+        scores = vectors @ query
+        if before_id is not None:
+            scores = np.where(ids < before_id, scores, -np.inf)
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if scores[i] >= min_score]
+
+class LongTermMemory:
+    """Индексирует записанные сообщения в фоне и находит среди старых те, что относятся к новому вопросу.
+
+    Новые сообщения приходят из слушателя коммитов сессии, а уже существующие сообщения чата
+    доиндексируются при первом обращении к нему в этом процессе.
+    """
+
+    def __init__(
+        self,
+        model_name: str = MEMORY_EMBEDDING_MODEL,
+        directory: str = MEMORY_DIR,
+        top_k: int = MEMORY_TOP_K,
+        min_score: float = MEMORY_MIN_SCORE,
+        token_budget: int = MEMORY_TOKEN_BUDGET,
+        max_chats: int = MEMORY_MAX_CHATS,
+    ):
+        self.enabled = bool(model_name)
+        self.embedder = Embedder(model_name) if self.enabled else None
+        self.directory = os.path.join(directory, model_name.replace("/", "__")) if directory and model_name else ""
+        self.top_k = top_k
+        self.min_score = min_score
+        self.token_budget = token_budget
+        self.max_chats = max(1, max_chats)
+        self._indexes: "OrderedDict[int, ChatIndex]" = OrderedDict()
+        self._backfilled: Set[int] = set()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._background = set()
+        self.embedded = 0
+        self.batches = 0
+
+    @property
+    def is_ready(self) -> bool:
+        return self.enabled and self.embedder.model is not None
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        for task in list(self._background):
+            task.cancel()
+        await asyncio.gather(self._task, *self._background, return_exceptions=True)
+        self._task = None
+        # Неиндексированные сообщения доиндексируются при следующем обращении к чату
+        self._queue = None
+
+    def enqueue(self, chat_id: int, message_id: int, text: str):
+        if self._queue is None:
+            return
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (chat_id, message_id, text))
+
+    async def _run(self):
+        try:
+            await asyncio.to_thread(self.embedder.load)
+        except Exception as e:
+            logger.error(f"Модель эмбеддингов не загружена, долговременная память выключена: {str(e)}")
+            self.enabled = False
+            return
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        window_seconds = MEMORY_BATCH_WINDOW_MS / 1000
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + window_seconds
+            while len(batch) < MEMORY_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await asyncio.to_thread(self._index_batch, batch)
+            except Exception as e:
+                logger.error(f"Ошибка индексации {len(batch)} сообщений: {str(e)}")
+
+    def _index_batch(self, batch: List[Tuple[int, int, str]]):
+        import numpy as np
+
+        vectors = self.embedder.embed([text for _, _, text in batch])
+        by_chat = {}
+        for row, (chat_id, message_id, _) in enumerate(batch):
+            by_chat.setdefault(chat_id, []).append((message_id, row))
+        for chat_id, items in by_chat.items():
+            ids = np.array([message_id for message_id, _ in items], dtype=np.int64)
+            self._index(chat_id).add(ids, vectors[[row for _, row in items]])
+        self.embedded += len(batch)
+        self.batches += 1
+
+    def _index(self, chat_id: int) -> ChatIndex:
+        with self._lock:
+            index = self._indexes.get(chat_id)
+            if index is None:
+                path = os.path.join(self.directory, f"chat-{chat_id}") if self.directory else None
+                index = self._indexes[chat_id] = ChatIndex(self.embedder.dim, path)
+                while len(self._indexes) > self.max_chats:
+                    evicted, _ = self._indexes.popitem(last=False)
+                    # Индекс в памяти вытеснен целиком, при следующем обращении чат индексируется заново
+                    if not self.directory:
+                        self._backfilled.discard(evicted)
+            self._indexes.move_to_end(chat_id)
+            return index
+
+    async def _backfill(self, chat_id: int):
+        try:
+            index = self._index(chat_id)
+            async with async_session() as session:
+                result = await session.execute(
+                    select(Message.id, Message.content).filter(Message.chat_id == chat_id).order_by(Message.id)
+                )
+                rows = result.all()
+            known = set(index.ids.tolist())
+            missing = [(message_id, content) for message_id, content in rows if message_id not in known and content]
+            for message_id, content in missing:
+                self.enqueue(chat_id, message_id, content)
+            if missing:
+                logger.debug(f"Чат {chat_id}: в долговременную память поставлено {len(missing)} сообщений")
+        except Exception as e:
+            with self._lock:
+                self._backfilled.discard(chat_id)
+            logger.error(f"Ошибка доиндексации чата {chat_id}: {str(e)}")
+
+    async def recall(self, chat_id: int, query: str, before_id: Optional[int]) -> List[HistoryRow]:
+        """Самые близкие к query сообщения чата с id меньше before_id — в пределах бюджета токенов,
+        в хронологическом порядке."""
+        if not self.is_ready:
+            return []
+        with self._lock:
+            backfill = chat_id not in self._backfilled
+            self._backfilled.add(chat_id)
+        if backfill:
+            task = asyncio.create_task(self._backfill(chat_id))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        index = self._index(chat_id)
+        if not len(index.ids):
+            return []
+        query_vector = (await asyncio.to_thread(self.embedder.embed, [query]))[0]
+        hits = index.search(query_vector, self.top_k, before_id, self.min_score)
+        if not hits:
+            return []
+        async with async_session() as session:
+            result = await session.execute(
+                select(Message.id, Message.role, Message.content, Message.token_count)
+                .filter(Message.id.in_([message_id for message_id, _ in hits]))
+            )
+            rows = {row[0]: tuple(row) for row in result.all()}
+        selected = []
+        used = 0
+        for message_id, _ in hits:
+            row = rows.get(message_id)
+            if row is None:
+                continue
+            tokens = row_tokens(row)
+            if used + tokens > self.token_budget:
+                continue
+            used += tokens
+            selected.append(row)
+        return sorted(selected)
+
+    def stats(self) -> dict:
+        with self._lock:
+            chats = len(self._indexes)
+        return {
+            "enabled": self.enabled,
+            "ready": self.is_ready,
+            "on_disk": bool(self.directory),
+            "chats": chats,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "embedded": self.embedded,
+            "avg_batch_size": self.embedded / self.batches if self.batches else 0.0,
+        }
+
+long_term_memory = LongTermMemory()
+
+@event.listens_for(Session, "after_flush")
+def _collect_messages_for_memory(session, flush_context):
+    if not long_term_memory.enabled:
+        return
+    rows = [
+        (obj.chat_id, obj.id, obj.content)
+        for obj in session.new
+        if isinstance(obj, Message) and obj.content
+    ]
+    if rows:
+        session.info.setdefault("memory_rows", []).extend(rows)
+
+@event.listens_for(Session, "after_commit")
+def _index_committed_messages(session):
+    for chat_id, message_id, content in session.info.pop("memory_rows", []):
+        long_term_memory.enqueue(chat_id, message_id, content)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_messages_for_memory(session):
+    session.info.pop("memory_rows", None)
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+from database import async_session
+from models import Message
+from token_counter import token_counter
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_WRITE_WINDOW_MS = float(os.getenv("MESSAGE_WRITE_WINDOW_MS", "5"))
+MESSAGE_WRITE_BATCH = int(os.getenv("MESSAGE_WRITE_BATCH", "64"))
+
+class MessageWriter:
+    """Сохраняет сообщения пачками: записи от параллельных запросов, пришедшие за короткое окно,
+    вставляются одной транзакцией, и каждый запрос получает свой Message с id и timestamp.
+
+    Значения по умолчанию у Message вычисляются на стороне Python, поэтому после коммита
+    refresh() не нужен. Если транзакция пачки не прошла, сообщения пишутся по одному,
+    чтобы ошибка одного не задела остальные. Длина сообщений в токенах считается до коммита в потоке,
+    чтобы токенизация длинного текста не занимала цикл событий.
+    """
+
+    def __init__(self, window_ms: float = MESSAGE_WRITE_WINDOW_MS, max_batch_size: int = MESSAGE_WRITE_BATCH):
+        self.window_seconds = window_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.messages = 0
+
+    async def start(self):
+        if self._task and not self._task.done():
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Дописывает уже принятые сообщения и останавливает запись.
+
+        Цикл не отменяется, а получает None: пачка, которая пишется в этот момент, успевает сохраниться.
+        """
+        if not self._task:
+            return
+        self._queue.put_nowait(None)
+        try:
+            await self._task
+        except Exception as e:
+            logger.error(f"Ошибка записи сообщений при остановке: {str(e)}")
+        self._task = None
+        # Сообщения, поставленные в очередь после None
+        batch = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                batch.append(item)
+        if batch:
+            await self._write(batch)
+
+    async def write(self, chat_id: int, role: str, content: str) -> Message:
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((Message(content=content, role=role, chat_id=chat_id), future))
+        return await future
+
+    def write_nowait(self, chat_id: int, role: str, content: str) -> asyncio.Future:
+        """Ставит сообщение в очередь, не дожидаясь записи, — там, где ждать уже нельзя
+        (например, в обработчике отключения клиента). Ошибка записи только логируется."""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_failure)
+        self._queue.put_nowait((Message(content=content, role=role, chat_id=chat_id), future))
+        return future
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + self.window_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+            if stopping:
+                return
+
+    async def _write(self, batch):
+        await self._count_tokens([message for message, _ in batch])
+        try:
+            await self._commit([message for message, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                _resolve(batch[0][1], error=e)
+                return
+            logger.warning(f"Пачка из {len(batch)} сообщений не сохранена ({str(e)}), запись по одному")
+            for message, future in batch:
+                # Объект из откатившейся сессии не переиспользуется
+                retry = Message(
+                    content=message.content, role=message.role, chat_id=message.chat_id, token_count=message.token_count
+                )
+                try:
+                    await self._commit([retry])
+                except Exception as error:
+                    _resolve(future, error=error)
+                else:
+                    _resolve(future, retry)
+            return
+        self.batches += 1
+        self.messages += len(batch)
+        for message, future in batch:
+            _resolve(future, message)
+
+    async def _count_tokens(self, messages: List[Message]):
+        if not token_counter.is_ready:
+            return
+        try:
+            counts = await asyncio.to_thread(token_counter.count_many, [message.content or "" for message in messages])
+        except Exception as e:
+            logger.warning(f"Не удалось посчитать токены сообщений: {str(e)}")
+            return
+        for message, count in zip(messages, counts):
+            message.token_count = count
+
+    async def _commit(self, messages: List[Message]):
+        async with async_session() as session:
+            session.add_all(messages)
+            await session.commit()
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": self.messages / self.batches if self.batches else 0.0,
+        }
+
+def _resolve(future: asyncio.Future, message: Optional[Message] = None, error: Optional[Exception] = None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(message)
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Ошибка фоновой записи сообщения: {str(future.exception())}")
+
+message_writer = MessageWriter()
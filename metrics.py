@@ -0,0 +1,217 @@
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+LabelValues = Tuple[str, ...]
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Gauge(Metric):
+    """Значение задаётся явно или вычисляется функцией в момент сбора метрик."""
+
+    kind = "gauge"
+
+    def __init__(self, *args, function: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        if self.function is not None:
+            yield f"{self.name} {_format_value(self.function())}"
+            return
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счётчики по корзинам, сумма, количество
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+class MetricsRegistry:
+    """Метрики процесса в текстовом формате Prometheus.
+
+    В процессах инференса наблюдения не копятся локально, а пересылаются в процесс API через forward.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self.forward: Optional[Callable[[str, str, float, dict], None]] = None
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def record(self, name: str, method: str, value: float, **labels):
+        if self.forward is not None:
+            self.forward(name, method, value, labels)
+            return
+        self.apply(name, method, value, labels)
+
+    def apply(self, name: str, method: str, value: float, labels: dict):
+        metric = self._metrics.get(name)
+        if metric is not None:
+            getattr(metric, method)(value, **labels)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+REQUEST_LATENCY = registry.register(Histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запроса", ("method", "route", "status")
+))
+TIME_TO_FIRST_TOKEN = registry.register(Histogram(
+    "generation_time_to_first_token_seconds", "Время до первого токена потокового ответа"
+))
+GENERATION_DURATION = registry.register(Histogram(
+    "generation_duration_seconds", "Длительность вызова generate", ("mode",)
+))
+TOKENS_PER_SECOND = registry.register(Histogram(
+    "generation_tokens_per_second", "Скорость генерации одной последовательности", buckets=RATE_BUCKETS
+))
+PROMPT_TOKENS = registry.register(Histogram(
+    "generation_prompt_tokens", "Длина промпта в токенах", buckets=TOKEN_BUCKETS
+))
+COMPLETION_TOKENS = registry.register(Histogram(
+    "generation_completion_tokens", "Длина ответа в токенах", buckets=TOKEN_BUCKETS
+))
+BATCH_SIZE = registry.register(Histogram(
+    "generation_batch_size", "Размер батча планировщика генерации", buckets=SIZE_BUCKETS
+))
+BATCH_QUEUE_WAIT = registry.register(Histogram(
+    "generation_queue_wait_seconds", "Ожидание промпта в очереди планировщика или потока в очереди допуска",
+    ("mode",)
+))
+GENERATION_THROTTLED = registry.register(Counter(
+    "generation_throttled", "Генерации, отклонённые ограничениями на пользователя", ("reason",)
+))
+SPECULATIVE_ACCEPTANCE = registry.register(Histogram(
+    "speculative_acceptance_ratio", "Доля принятых токенов черновой модели за генерацию", buckets=RATIO_BUCKETS
+))
+SPECULATIVE_GENERATIONS = registry.register(Counter(
+    "speculative_generations", "Одиночные генерации по режиму декодирования", ("mode",)
+))
+SPECULATIVE_ACTIVE = registry.register(Gauge(
+    "speculative_decoding_active", "Включено ли спекулятивное декодирование в процессе", ("process",)
+))
+STARTUP_SECONDS = registry.register(Gauge(
+    "startup_phase_seconds", "Длительность фаз старта процесса API", ("phase",)
+))
+MODEL_LOAD_SECONDS = registry.register(Gauge(
+    "model_load_seconds", "Время загрузки и прогрева модели", ("process",)
+))
+DB_QUERY_LATENCY = registry.register(Histogram(
+    "db_query_duration_seconds", "Время выполнения SQL-запроса", ("operation",)
+))
+DB_POOL_CHECKOUT_WAIT = registry.register(Histogram(
+    "db_pool_checkout_wait_seconds", "Ожидание соединения из пула БД"
+))
+
+def gauge(name: str, documentation: str, function: Callable[[], float]) -> Gauge:
+    return registry.register(Gauge(name, documentation, function=function))
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, sample_rate: float = LOG_SAMPLE_RATE, **fields):
+    """Структурная запись о событии горячего пути; пишется лишь доля sample_rate таких событий.
+
+    Содержимое сообщений сюда не передаётся — только размеры и идентификаторы.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    logger.log(level, json.dumps({"event": event, **fields}, ensure_ascii=False, default=str))
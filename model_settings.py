@@ -0,0 +1,4 @@
+import os
+
+# Основная модель; отдельно от llm, чтобы лёгкие модули (подсчёт токенов) не тянули фасад генерации
+MODEL_NAME = os.getenv("MODEL_NAME", "Qwen/Qwen2-1.5B-Instruct")
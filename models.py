@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
@@ -20,6 +20,12 @@ class RefreshToken(Base):
     created_at = Column(DateTime, default=lambda: datetime.now())
     user = relationship("User", back_populates="refresh_tokens")
 
+    # Ограничение числа токенов пользователя и очистка истёкших идут по индексам
+    __table_args__ = (
+        Index("ix_refresh_tokens_user_id_id", "user_id", "id"),
+        Index("ix_refresh_tokens_expires_at", "expires_at"),
+    )
+
 class Chat(Base):
     __tablename__ = "chats"
     id = Column(Integer, primary_key=True, index=True)
@@ -31,6 +37,37 @@ class Message(Base):
     id = Column(Integer, primary_key=True, index=True)
     content = Column(String)
     role = Column(String)
+    # Длина content в токенах модели, считается один раз при записи; NULL — не посчитана
+    token_count = Column(Integer)
     timestamp = Column(DateTime, default=lambda: datetime.now())
     chat_id = Column(Integer, ForeignKey("chats.id"))
-    chat = relationship("Chat", back_populates="messages")
\ No newline at end of file
+    chat = relationship("Chat", back_populates="messages")
+
+    # Выборка сообщений чата по курсору id идёт по этому индексу без сортировки
+    __table_args__ = (Index("ix_messages_chat_id_id", "chat_id", "id"),)
+
+class GenerationJob(Base):
+    __tablename__ = "generation_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
+    content = Column(String, nullable=False)
+    # sub пользователя, поставившего задачу: по нему считаются его одновременные генерации
+    owner = Column(String)
+    # pending | running | done | failed | cancelled
+    status = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    claim_token = Column(String)
+    error = Column(String)
+    result_message_id = Column(Integer, ForeignKey("messages.id"))
+    created_at = Column(DateTime, default=lambda: datetime.now())
+    started_at = Column(DateTime)
+    # Обновляется процессом, выполняющим задачу; задача без свежей отметки считается брошенной
+    heartbeat_at = Column(DateTime)
+    # Повтор после ошибки не берётся в работу раньше этого времени
+    retry_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_generation_jobs_status_id", "status", "id"),
+        Index("ix_generation_jobs_owner_status", "owner", "status"),
+    )
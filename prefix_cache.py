@@ -0,0 +1,127 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+PREFIX_CACHE_MAX_BYTES = int(os.getenv("PREFIX_CACHE_MAX_MB", "512")) * 1024 * 1024
+# Кроме системного промпта кэшировать и промпт каждого последнего запроса
+PREFIX_CACHE_PROMPTS = os.getenv("PREFIX_CACHE_PROMPTS", "1") == "1"
+# Префиксы короче этого не стоят поиска и копирования
+PREFIX_CACHE_MIN_TOKENS = 16
+
+def _legacy(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+def slice_cache(past_key_values, length: int, clone: bool = False):
+    """Обрезает кэш ключей/значений до первых length позиций.
+
+    Без clone срезы ссылаются на исходные тензоры: generate дописывает кэш через torch.cat,
+    поэтому сохранённые тензоры не меняются.
+    """
+    layers = []
+    for key, value in _legacy(past_key_values):
+        key, value = key[:, :, :length], value[:, :, :length]
+        if clone:
+            key, value = key.clone(), value.clone()
+        layers.append((key, value))
+    return DynamicCache.from_legacy_cache(tuple(layers))
+
+def cache_nbytes(past_key_values) -> int:
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for layer in _legacy(past_key_values)
+        for tensor in layer
+    )
+
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    length = min(a.shape[0], b.shape[0])
+    if length == 0:
+        return 0
+    return int((a[:length] == b[:length]).int().cumprod(0).sum())
+
+class PrefixEntry:
+    def __init__(self, token_ids: torch.Tensor, past_key_values, pinned: bool = False):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = cache_nbytes(past_key_values)
+        self.pinned = pinned
+
+class PrefixCache:
+    """LRU ключей/значений внимания для префиксов промптов с ограничением по памяти.
+
+    Новый запрос продолжает генерацию с самого длинного совпадающего префикса вместо полного prefill.
+    """
+
+    def __init__(self, max_bytes: int = PREFIX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: "OrderedDict[Hashable, PrefixEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, token_ids: torch.Tensor) -> Tuple[int, Optional[DynamicCache]]:
+        """Возвращает длину переиспользуемого префикса и кэш для него.
+
+        Хотя бы один токен промпта всегда остаётся непросчитанным — generate нужен вход для первого шага.
+        """
+        limit = token_ids.shape[0] - 1
+        best_key, best_length = None, 0
+        with self._lock:
+            for key, entry in self._entries.items():
+                length = min(common_prefix_length(entry.token_ids, token_ids), limit)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None or best_length < PREFIX_CACHE_MIN_TOKENS:
+                self.misses += 1
+                return 0, None
+            entry = self._entries[best_key]
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            self.reused_tokens += best_length
+        return best_length, slice_cache(entry.past_key_values, best_length)
+
+    def store(self, key: Hashable, token_ids: torch.Tensor, past_key_values, pinned: bool = False):
+        length = token_ids.shape[0]
+        if length < PREFIX_CACHE_MIN_TOKENS:
+            return
+        entry = PrefixEntry(token_ids.clone(), slice_cache(past_key_values, length, clone=True), pinned)
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._entries[key] = entry
+            self.nbytes += entry.nbytes
+            self._evict()
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self.nbytes <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.pinned:
+                continue
+            del self._entries[key]
+            self.nbytes -= entry.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "megabytes": round(self.nbytes / 1024 / 1024, 2),
+                "max_megabytes": round(self.max_bytes / 1024 / 1024, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "reused_tokens": self.reused_tokens,
+            }
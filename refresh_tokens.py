@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth import REFRESH_TOKEN_EXPIRE_DAYS, TokenCache, create_refresh_token
+from database import async_session
+from models import RefreshToken, User
+
+logger = logging.getLogger(__name__)
+
+REFRESH_TOKEN_PURGE_SECONDS = float(os.getenv("REFRESH_TOKEN_PURGE_SECONDS", "3600"))
+REFRESH_TOKENS_PER_USER = int(os.getenv("REFRESH_TOKENS_PER_USER", "10"))
+# 0 — проверенные refresh-токены не кэшируются
+REFRESH_TOKEN_CACHE_SIZE = int(os.getenv("REFRESH_TOKEN_CACHE_SIZE", "1024"))
+REFRESH_TOKEN_CACHE_SECONDS = float(os.getenv("REFRESH_TOKEN_CACHE_SECONDS", "60"))
+
+class RefreshTokenStore:
+    """Выдача, проверка и отзыв refresh-токенов.
+
+    У пользователя остаётся не больше max_per_user активных токенов (старые удаляются при выдаче нового),
+    истёкшие строки периодически вычищаются фоновой задачей. Проверка — один запрос токена вместе
+    с пользователем; результат кэшируется на cache_seconds, так что отзыв в другом процессе
+    вступает в силу не позже чем через это время.
+    """
+
+    def __init__(
+        self,
+        max_per_user: int = REFRESH_TOKENS_PER_USER,
+        purge_seconds: float = REFRESH_TOKEN_PURGE_SECONDS,
+        cache_size: int = REFRESH_TOKEN_CACHE_SIZE,
+        cache_seconds: float = REFRESH_TOKEN_CACHE_SECONDS,
+    ):
+        self.max_per_user = max(1, max_per_user)
+        self.purge_seconds = purge_seconds
+        self.cache_seconds = cache_seconds
+        self.cache = TokenCache(cache_size) if cache_size > 0 else None
+        self._task: Optional[asyncio.Task] = None
+
+    async def issue(self, db: AsyncSession, user_id: int) -> str:
+        """Добавляет новый токен в текущую транзакцию; коммит остаётся за вызывающим."""
+        token = create_refresh_token()
+        db.add(RefreshToken(
+            token=token,
+            user_id=user_id,
+            expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+        ))
+        # Новый токен попадает в выборку через autoflush; у пользователя остаются max_per_user самых свежих
+        result = await db.execute(
+            select(RefreshToken.id, RefreshToken.token)
+            .where(RefreshToken.user_id == user_id)
+            .order_by(RefreshToken.id.desc())
+            .offset(self.max_per_user)
+        )
+        evicted = result.all()
+        if evicted:
+            await db.execute(delete(RefreshToken).where(RefreshToken.id.in_([row.id for row in evicted])))
+            for row in evicted:
+                self._forget(row.token)
+        return token
+
+    async def validate(self, db: AsyncSession, token: str) -> Optional[dict]:
+        """Возвращает {"user_id", "sub"} для действующего токена или None."""
+        if self.cache is not None:
+            payload = self.cache.get(token)
+            if payload is not None:
+                return payload
+        now = datetime.utcnow()
+        result = await db.execute(
+            select(RefreshToken.user_id, RefreshToken.expires_at, User.email)
+            .join(User, User.id == RefreshToken.user_id)
+            .where(RefreshToken.token == token, RefreshToken.expires_at > now)
+        )
+        row = result.first()
+        if row is None:
+            return None
+        payload = {"user_id": row.user_id, "sub": row.email}
+        if self.cache is not None:
+            cached_until = min(now + timedelta(seconds=self.cache_seconds), row.expires_at)
+            self.cache.put(token, {**payload, "exp": time.time() + (cached_until - now).total_seconds()})
+        return payload
+
+    async def revoke(self, db: AsyncSession, token: str):
+        self._forget(token)
+        await db.execute(delete(RefreshToken).where(RefreshToken.token == token))
+        await db.commit()
+
+    def _forget(self, token: str):
+        if self.cache is not None:
+            self.cache.discard(token)
+
+    async def purge(self) -> int:
+        async with async_session() as session:
+            result = await session.execute(delete(RefreshToken).where(RefreshToken.expires_at <= datetime.utcnow()))
+            await session.commit()
+        if result.rowcount:
+            logger.info(f"Удалено истёкших refresh-токенов: {result.rowcount}")
+        return result.rowcount
+
+    async def start(self):
+        if self.purge_seconds > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.purge()
+            except Exception as e:
+                logger.error(f"Ошибка очистки refresh-токенов: {str(e)}")
+            await asyncio.sleep(self.purge_seconds)
+
+refresh_tokens = RefreshTokenStore()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# off | memory | sqlite
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE", "off")
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_MB", "64")) * 1024 * 1024
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+
+def make_cache_key(prompt: str, model_config: dict) -> str:
+    """Ключ ответа: хэш полностью собранного промпта и параметров модели."""
+    payload = json.dumps(model_config, sort_keys=True, default=str) + "\0" + prompt
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    backend = None
+
+    def __init__(self, ttl_seconds: int = RESPONSE_CACHE_TTL_SECONDS, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key: str, value: str):
+        nbytes = len(value.encode("utf-8"))
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._set(key, value, nbytes, time.time())
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.backend,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                **self._usage(),
+            }
+
+class MemoryResponseCache(ResponseCache):
+    backend = "memory"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._nbytes = 0
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at, nbytes = entry
+        if expires_at <= now:
+            del self._entries[key]
+            self._nbytes -= nbytes
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, nbytes, now):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._nbytes -= previous[2]
+        self._entries[key] = (value, now + self.ttl_seconds, nbytes)
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self._nbytes -= evicted
+
+    def _usage(self):
+        return {"entries": len(self._entries), "bytes": self._nbytes, "max_bytes": self.max_bytes}
+
+class SQLiteResponseCache(ResponseCache):
+    """Кэш ответов в файле SQLite: переживает перезапуск и общий для процессов на одной машине."""
+
+    backend = "sqlite"
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, nbytes INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at)")
+
+    def _get(self, key, now):
+        row = self._connection.execute(
+            "SELECT value FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _set(self, key, value, nbytes, now):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO responses (key, value, nbytes, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, value, nbytes, now + self.ttl_seconds, now)
+        )
+        self._connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        total = self._connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            # Удаляем давно не читавшиеся записи, пока не уложимся в бюджет
+            rows = self._connection.execute("SELECT key, nbytes FROM responses ORDER BY accessed_at").fetchall()
+            stale = []
+            for stale_key, stale_bytes in rows:
+                if total <= self.max_bytes:
+                    break
+                stale.append((stale_key,))
+                total -= stale_bytes
+            self._connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def _usage(self):
+        entries, nbytes = self._connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM responses"
+        ).fetchone()
+        return {"entries": entries, "bytes": nbytes, "max_bytes": self.max_bytes, "path": self.path}
+
+def create_response_cache() -> Optional[ResponseCache]:
+    if RESPONSE_CACHE_BACKEND == "memory":
+        cache = MemoryResponseCache()
+    elif RESPONSE_CACHE_BACKEND == "sqlite":
+        cache = SQLiteResponseCache()
+    else:
+        return None
+    logger.info(
+        f"Кэш ответов включён: {cache.backend}, TTL {cache.ttl_seconds} с, "
+        f"бюджет {cache.max_bytes // 1024 // 1024} МБ"
+    )
+    return cache
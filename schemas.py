@@ -1,11 +1,12 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 class MessageCreate(BaseModel):
     content: str
 
 class MessageResponse(BaseModel):
+    id: int
     content: str
     role: str
     timestamp: datetime
@@ -19,4 +20,18 @@ class ChatResponse(BaseModel):
     messages: List[MessageResponse] = []
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class JobResponse(BaseModel):
+    id: int
+    chat_id: int
+    status: str
+    attempts: int
+    error: Optional[str] = None
+    result_message_id: Optional[int] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
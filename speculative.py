@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from transformers import AutoModelForCausalLM
+
+import metrics
+from inference_profile import InferenceProfile, prepare_model
+
+logger = logging.getLogger(__name__)
+
+# Пустое значение — спекулятивное декодирование выключено
+SPECULATIVE_DRAFT_MODEL = os.getenv("SPECULATIVE_DRAFT_MODEL", "")
+# Сколько токенов черновая модель предлагает за шаг; 0 — эвристика transformers подбирает сама
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "5"))
+# Ниже этой доли принятых токенов спекулятивное декодирование медленнее обычного
+SPECULATIVE_MIN_ACCEPTANCE = float(os.getenv("SPECULATIVE_MIN_ACCEPTANCE", "0.3"))
+SPECULATIVE_WINDOW = int(os.getenv("SPECULATIVE_WINDOW", "20"))
+# Через столько обычных генераций после отключения спекулятивный режим пробуется снова
+SPECULATIVE_RETRY_AFTER = int(os.getenv("SPECULATIVE_RETRY_AFTER", "200"))
+
+class _ForwardCounter(threading.local):
+    active = False
+    target = 0
+    draft = 0
+
+class SpeculativeDecoder:
+    """Ассистированная генерация с малой черновой моделью (только для greedy-декодирования).
+
+    Черновая модель предлагает draft_tokens токенов, основная проверяет их одним проходом, поэтому
+    ответ совпадает с обычным greedy-декодированием. Доля принятых токенов считается по числу проходов
+    обеих моделей; если среднее по последним window генерациям падает ниже min_acceptance,
+    генерация переключается на обычное декодирование и через retry_after вызовов пробует снова.
+    """
+
+    def __init__(
+        self,
+        model_name: str = SPECULATIVE_DRAFT_MODEL,
+        draft_tokens: int = SPECULATIVE_DRAFT_TOKENS,
+        min_acceptance: float = SPECULATIVE_MIN_ACCEPTANCE,
+        window: int = SPECULATIVE_WINDOW,
+        retry_after: int = SPECULATIVE_RETRY_AFTER,
+    ):
+        self.model_name = model_name
+        self.draft_tokens = draft_tokens
+        self.min_acceptance = min_acceptance
+        self.retry_after = retry_after
+        self.draft_model = None
+        self._recent = deque(maxlen=max(1, window))
+        self._plain_left = 0
+        self._counter = _ForwardCounter()
+        self._lock = threading.Lock()
+
+    def load(self, model, profile: InferenceProfile, generation_kwargs: dict):
+        if not self.model_name:
+            return
+        if generation_kwargs.get("do_sample") or generation_kwargs.get("num_beams", 1) > 1:
+            logger.warning("Спекулятивное декодирование поддерживается только для greedy-генерации, отключено")
+            return
+        logger.info(f"Загрузка черновой модели {self.model_name}...")
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            self.model_name,
+            torch_dtype=profile.torch_dtype,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True
+        ).to(profile.device)
+        if draft_model.config.vocab_size != model.config.vocab_size:
+            logger.warning(
+                f"Словарь черновой модели ({draft_model.config.vocab_size}) не совпадает с основной "
+                f"({model.config.vocab_size}), спекулятивное декодирование отключено"
+            )
+            return
+        draft_model = prepare_model(draft_model, profile)
+        if self.draft_tokens > 0:
+            draft_model.generation_config.num_assistant_tokens = self.draft_tokens
+            draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+        model.register_forward_hook(self._count_target)
+        draft_model.register_forward_hook(self._count_draft)
+        self.draft_model = draft_model
+        self._set_active(True)
+        logger.info(f"Черновая модель загружена, токенов за шаг: {self.draft_tokens or 'эвристика'}")
+
+    def _count_target(self, module, args, output):
+        if self._counter.active:
+            self._counter.target += 1
+
+    def _count_draft(self, module, args, output):
+        if self._counter.active:
+            self._counter.draft += 1
+
+    def _set_active(self, active: bool):
+        metrics.registry.record("speculative_decoding_active", "set", int(active), process=f"pid-{os.getpid()}")
+
+    def use(self) -> bool:
+        """Решает, идёт ли очередная генерация через черновую модель."""
+        if self.draft_model is None:
+            return False
+        with self._lock:
+            if self._plain_left > 0:
+                self._plain_left -= 1
+                if self._plain_left == 0:
+                    logger.info("Повторная попытка спекулятивного декодирования")
+                    self._recent.clear()
+                    self._set_active(True)
+                return False
+            return True
+
+    @contextmanager
+    def track(self, speculative: bool):
+        """Считает проходы моделей во время одного вызова generate в текущем потоке."""
+        counter = self._counter
+        counter.active, counter.target, counter.draft = speculative, 0, 0
+        try:
+            yield
+        finally:
+            counter.active = False
+            metrics.registry.record("speculative_generations", "inc", 1, mode="speculative" if speculative else "plain")
+
+    def record(self, new_tokens: int):
+        """Учитывает долю принятых токенов генерации, прошедшей внутри track(speculative=True)."""
+        rounds, proposed = self._counter.target, self._counter.draft
+        if proposed == 0:
+            return
+        # Каждый проход основной модели даёт один собственный токен сверх принятых черновых
+        acceptance = min(1.0, max(0, new_tokens - rounds) / proposed)
+        metrics.registry.record("speculative_acceptance_ratio", "observe", acceptance)
+        with self._lock:
+            self._recent.append(acceptance)
+            if len(self._recent) < self._recent.maxlen:
+                return
+            average = sum(self._recent) / len(self._recent)
+            if average < self.min_acceptance and self._plain_left == 0:
+                self._plain_left = self.retry_after
+                self._set_active(False)
+                logger.warning(
+                    f"Доля принятых черновых токенов {average:.2f} ниже {self.min_acceptance}, "
+                    f"обычное декодирование на {self.retry_after} генераций"
+                )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "draft_model": self.model_name or None,
+                "loaded": self.draft_model is not None,
+                "active": self.draft_model is not None and self._plain_left == 0,
+                "recent_acceptance": sum(self._recent) / len(self._recent) if self._recent else None,
+            }
@@ -0,0 +1,82 @@
+from typing import Sequence
+
+# Метки ролей, с которых модель начинает выдумывать следующую реплику диалога. Метка считается только
+# в начале строки (начало ответа — тоже начало строки): упоминание "Assistant:" посреди фразы ответ не обрывает
+STOP_SEQUENCES = ("\nHuman:", "\nSystem:", "\nAssistant:", "\nAI:")
+# Метка роли в самом начале ответа — эхо формата промпта; она отрезается, а не останавливает генерацию
+ROLE_PREFIXES = ("Assistant:", "AI:")
+
+class StopSequenceMatcher:
+    """Инкрементальный поиск стоп-последовательностей в тексте, который приходит частями.
+
+    feed() возвращает только тот текст, который уже точно не станет началом стоп-последовательности;
+    хвост, похожий на её начало, придерживается до следующей части. После совпадения matcher
+    переходит в stopped, а всё, начиная со стоп-последовательности, отбрасывается.
+    """
+
+    def __init__(self, stops: Sequence[str] = STOP_SEQUENCES, role_prefixes: Sequence[str] = ROLE_PREFIXES):
+        self.stops = tuple(stops)
+        self.role_prefixes = tuple(role_prefixes)
+        self.stopped = False
+        self._buffer = ""
+        # Начало ответа пройдено: метка роли снята или её там нет
+        self._started = False
+        # Буфер начинается с начала ответа: для поиска меток к нему приписывается перевод строки
+        self._at_reply_start = True
+
+    def feed(self, text: str) -> str:
+        if self.stopped:
+            return ""
+        self._buffer += text
+        if not self._started and not self._skip_role_prefix():
+            return ""
+
+        lead = "\n" if self._at_reply_start else ""
+        text = lead + self._buffer
+        index = min((i for i in (text.find(stop) for stop in self.stops) if i >= 0), default=-1)
+        if index >= 0:
+            emitted, self._buffer = text[len(lead):max(index, len(lead))], ""
+            self.stopped = True
+            return emitted
+
+        held = min(self._held_length(text), len(self._buffer))
+        emitted, self._buffer = self._buffer[:len(self._buffer) - held], self._buffer[len(self._buffer) - held:]
+        if emitted:
+            self._at_reply_start = False
+        return emitted
+
+    def finish(self) -> str:
+        """Отдаёт придержанный остаток, когда текст закончился без стоп-последовательности."""
+        if self.stopped:
+            return ""
+        emitted, self._buffer = self._buffer, ""
+        return emitted
+
+    def _skip_role_prefix(self) -> bool:
+        """Снимает метку роли в начале; False — пока нельзя понять, метка это или нет."""
+        stripped = self._buffer.lstrip()
+        if not stripped:
+            return False
+        for prefix in self.role_prefixes:
+            if stripped.startswith(prefix):
+                self._buffer = stripped[len(prefix):]
+                self._started = True
+                return True
+        if any(prefix.startswith(stripped) for prefix in self.role_prefixes):
+            return False
+        self._started = True
+        return True
+
+    def _held_length(self, text: str) -> int:
+        held = 0
+        for stop in self.stops:
+            for length in range(min(len(stop) - 1, len(text)), held, -1):
+                if text.endswith(stop[:length]):
+                    held = length
+                    break
+        return held
+
+def truncate_at_stop(text: str, stops: Sequence[str] = STOP_SEQUENCES) -> str:
+    """Обрезает готовый текст так же, как его обрезал бы поток: без метки роли в начале и до первой стоп-последовательности."""
+    matcher = StopSequenceMatcher(stops)
+    return matcher.feed(text) + matcher.finish()
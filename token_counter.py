@@ -0,0 +1,72 @@
+"""Длина текста в токенах модели — для сообщений, записываемых в БД.
+
+Загружается только токенизатор (без torch и весов модели), в фоне после старта API.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+from typing import List, Optional, Sequence
+
+from model_settings import MODEL_NAME
+
+logger = logging.getLogger(__name__)
+
+# Оценка для сообщений без сохранённой длины (записанных до появления столбца или до загрузки токенизатора)
+CHARS_PER_TOKEN = 3
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+class TokenCounter:
+    """Считает токены токенизатором модели; пока токенизатор не загружен, count() возвращает None."""
+
+    def __init__(self, model_name: str = MODEL_NAME):
+        self.model_name = model_name
+        self.tokenizer = None
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.tokenizer is not None
+
+    def load(self):
+        with self._lock:
+            if self.tokenizer is not None:
+                return
+            started = time.perf_counter()
+            from transformers import AutoTokenizer
+
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            logger.info(f"Токенизатор для подсчёта токенов загружен за {time.perf_counter() - started:.2f} секунд")
+
+    async def start(self):
+        """Загружает токенизатор в фоне: старт API его не ждёт."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._load_in_background())
+
+    async def _load_in_background(self):
+        try:
+            await asyncio.to_thread(self.load)
+        except Exception as e:
+            logger.warning(f"Токенизатор не загружен, длина истории будет оцениваться по символам: {str(e)}")
+
+    def count(self, text: str) -> Optional[int]:
+        if self.tokenizer is None:
+            return None
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    async def acount(self, text: str) -> Optional[int]:
+        """count() вне цикла событий: токенизация длинного текста не должна его занимать."""
+        if self.tokenizer is None or not text:
+            return None
+        return await asyncio.to_thread(self.count, text)
+
+    def count_many(self, texts: Sequence[str]) -> List[Optional[int]]:
+        if self.tokenizer is None:
+            return [None] * len(texts)
+        return [len(ids) for ids in self.tokenizer(list(texts), add_special_tokens=False).input_ids]
+
+token_counter = TokenCounter()
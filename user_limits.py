@@ -0,0 +1,127 @@
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from fastapi import HTTPException, status
+
+from metrics import GENERATION_THROTTLED
+
+# Средняя частота генераций на пользователя; 0 — без ограничения
+USER_GENERATIONS_PER_MINUTE = float(os.getenv("USER_GENERATIONS_PER_MINUTE", "20"))
+# Сколько генераций подряд можно запустить сверх средней частоты
+USER_GENERATION_BURST = int(os.getenv("USER_GENERATION_BURST", "5"))
+# Одновременные генерации пользователя (включая задачи в очереди); 0 — без ограничения
+USER_MAX_CONCURRENT_GENERATIONS = int(os.getenv("USER_MAX_CONCURRENT_GENERATIONS", "2"))
+USER_CONCURRENCY_RETRY_AFTER = 5
+USER_LIMITS_MAX_TRACKED = 10000
+
+# Пользователь, от имени которого идёт генерация; по нему планировщик чередует промпты разных пользователей
+current_owner: ContextVar[Optional[str]] = ContextVar("current_owner", default=None)
+
+@contextmanager
+def use_owner(owner: Optional[str]):
+    reset = current_owner.set(owner)
+    try:
+        yield owner
+    finally:
+        current_owner.reset(reset)
+
+class _UserState:
+    __slots__ = ("tokens", "updated", "active")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.active = 0
+
+class UserLimiter:
+    """Ограничения генерации на пользователя: token bucket на частоту и потолок одновременных генераций.
+
+    Отказ — 429 с Retry-After, до очереди планировщика, чтобы один пользователь не занимал модель
+    в ущерб остальным. Счётчик одновременных генераций живёт в процессе API; генерации, которых
+    в нём нет (задачи в БД), передаются в acquire() через queued.
+    """
+
+    def __init__(
+        self,
+        per_minute: float = USER_GENERATIONS_PER_MINUTE,
+        burst: int = USER_GENERATION_BURST,
+        max_concurrent: int = USER_MAX_CONCURRENT_GENERATIONS,
+        max_tracked: int = USER_LIMITS_MAX_TRACKED,
+    ):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.max_concurrent = max_concurrent
+        self.max_tracked = max_tracked
+        self._users: Dict[str, _UserState] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, user: str, queued: int = 0):
+        """Допускает генерацию пользователя; допущенную нужно завершить release()."""
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(user, now)
+            if self.max_concurrent > 0 and state.active + queued >= self.max_concurrent:
+                self._reject("concurrency", USER_CONCURRENCY_RETRY_AFTER, "Слишком много одновременных генераций")
+            if self.rate > 0:
+                if state.tokens < 1:
+                    retry_after = math.ceil((1 - state.tokens) / self.rate)
+                    self._reject("rate", retry_after, "Слишком частые запросы к модели")
+                state.tokens -= 1
+            state.active += 1
+
+    def release(self, user: str):
+        with self._lock:
+            state = self._users.get(user)
+            if state is not None and state.active > 0:
+                state.active -= 1
+
+    @contextmanager
+    def slot(self, user: str, queued: int = 0):
+        self.acquire(user, queued)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+    def _state(self, user: str, now: float) -> _UserState:
+        state = self._users.get(user)
+        if state is None:
+            if len(self._users) >= self.max_tracked:
+                self._prune(now)
+            state = self._users[user] = _UserState(self.burst, now)
+        elif self.rate > 0:
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        state.updated = now
+        return state
+
+    def _prune(self, now: float):
+        """Забывает пользователей без генераций, чьё ведро уже успело наполниться."""
+        for user, state in list(self._users.items()):
+            refilled = self.rate <= 0 or state.tokens + (now - state.updated) * self.rate >= self.burst
+            if state.active == 0 and refilled:
+                del self._users[user]
+
+    def _reject(self, reason: str, retry_after: int, detail: str):
+        GENERATION_THROTTLED.inc(reason=reason)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail,
+            headers={"Retry-After": str(max(1, retry_after))},
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "generations_per_minute": self.rate * 60,
+                "burst": self.burst,
+                "max_concurrent": self.max_concurrent,
+                "tracked_users": len(self._users),
+                "active": sum(state.active for state in self._users.values()),
+            }
+
+user_limiter = UserLimiter()
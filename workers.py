@@ -0,0 +1,405 @@
+import asyncio
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from fastapi import HTTPException, status
+
+import metrics
+from cancellation import CancelToken
+
+logger = logging.getLogger(__name__)
+
+# 0 — генерация выполняется в процессе API
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "64"))
+WORKER_HEARTBEAT_SECONDS = 2.0
+WORKER_SHUTDOWN_SECONDS = 10.0
+# Сколько раз подряд перезапускается процесс, упавший до готовности модели; дальше пул считается неисправным
+WORKER_MAX_START_FAILURES = int(os.getenv("INFERENCE_WORKER_MAX_START_FAILURES", "3"))
+
+def _heartbeat(worker_id: int, results):
+    while True:
+        time.sleep(WORKER_HEARTBEAT_SECONDS)
+        results.put(("heartbeat", worker_id, None))
+
+def _listen_controls(controls, active: dict, lock: threading.Lock):
+    """Принимает отмены (task_id, строка батча или None для всей задачи) для выполняемой задачи."""
+    while True:
+        message = controls.get()
+        if message is None:
+            return
+        task_id, row = message
+        with lock:
+            cancels = active.get(task_id, [])
+        for index, cancel in enumerate(cancels):
+            if row is None or row == index:
+                cancel.cancel()
+
+def _worker_main(worker_id: int, tasks, results, controls):
+    """Процесс инференса: держит свою копию модели и берёт задачи из общей очереди.
+
+    Отмены приходят по отдельной очереди controls и останавливают генерацию на ближайшем токене.
+    """
+    import generation
+
+    # Метрики генерации учитываются в процессе API, который отдаёт /metrics
+    metrics.registry.forward = lambda name, method, value, labels: results.put(
+        ("metric", worker_id, (name, method, value, labels))
+    )
+    try:
+        generation.registry.load()
+    except Exception as e:
+        # Ошибка загрузки (неверный MODEL_NAME, нехватка памяти) обычно повторится и после перезапуска
+        logger.error(f"Процесс инференса {worker_id} не загрузил модель: {str(e)}")
+        results.put(("load_failed", worker_id, str(e)))
+        raise SystemExit(1)
+    results.put(("ready", worker_id, {
+        "pid": os.getpid(),
+        "profile": generation.registry.profile.as_dict(),
+        "load_seconds": generation.registry.load_seconds,
+    }))
+    threading.Thread(target=_heartbeat, args=(worker_id, results), daemon=True).start()
+    active: Dict[int, List[CancelToken]] = {}
+    lock = threading.Lock()
+    threading.Thread(target=_listen_controls, args=(controls, active, lock), daemon=True).start()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, kind, payload = task
+        deadlines = payload[-1] if kind == "batch" else [payload[-1]]
+        cancels = [CancelToken(timeout=0, deadline=deadline) for deadline in deadlines]
+        # Токены регистрируются до started: отмены пул отправляет только после него
+        with lock:
+            active[task_id] = cancels
+        results.put(("started", worker_id, task_id))
+        try:
+            if kind == "batch":
+                prompts, _ = payload
+                results.put(("result", worker_id, (task_id, generation.generate_batch(prompts, cancels))))
+            elif kind == "stream":
+                prompt_text, cache_key, _ = payload
+                for chunk in generation.stream_generate(prompt_text, cache_key=cache_key, cancel=cancels[0]):
+                    if chunk:
+                        results.put(("token", worker_id, (task_id, chunk)))
+                results.put(("result", worker_id, (task_id, None)))
+            else:
+                raise ValueError(f"Неизвестный тип задачи: {kind}")
+        except Exception as e:
+            logger.error(f"Ошибка в процессе инференса {worker_id}: {str(e)}")
+            results.put(("error", worker_id, (task_id, str(e))))
+        finally:
+            with lock:
+                active.pop(task_id, None)
+
+class WorkerState:
+    def __init__(self, worker_id: int, process, start_failures: int = 0):
+        self.worker_id = worker_id
+        self.process = process
+        self.pid = None
+        self.ready = False
+        # Подряд идущие падения до готовности; сбрасывается, когда процесс загрузил модель
+        self.start_failures = start_failures
+        self.load_error: Optional[str] = None
+        self.started_at = time.monotonic()
+        self.last_heartbeat = self.started_at
+        self.current_task = None
+        self.task_started_at = None
+        self.tasks_done = 0
+        self.tasks_failed = 0
+        self.busy_seconds = 0.0
+
+    def health(self) -> dict:
+        now = time.monotonic()
+        busy_seconds = self.busy_seconds
+        if self.task_started_at is not None:
+            busy_seconds += now - self.task_started_at
+        uptime = now - self.started_at
+        return {
+            "worker_id": self.worker_id,
+            "pid": self.pid,
+            "alive": self.process.is_alive(),
+            "ready": self.ready,
+            "start_failures": self.start_failures,
+            "busy": self.current_task is not None,
+            "tasks_done": self.tasks_done,
+            "tasks_failed": self.tasks_failed,
+            "utilization": busy_seconds / uptime if uptime else 0.0,
+            "heartbeat_age_seconds": round(now - self.last_heartbeat, 2),
+        }
+
+class PendingTask:
+    def __init__(self, loop: asyncio.AbstractEventLoop, size: int, stream: bool):
+        self.loop = loop
+        self.size = size
+        self.future = None if stream else loop.create_future()
+        self.tokens: Optional[asyncio.Queue] = asyncio.Queue() if stream else None
+        self.worker_id = None
+        # Строки, отменённые до того, как задачу взял процесс инференса
+        self.cancelled_rows: Set[Optional[int]] = set()
+
+class InferencePool:
+    """Пул процессов инференса с ограниченной очередью задач.
+
+    Каждый процесс загружает модель через generation.registry; задачи (батч промптов или потоковая генерация)
+    попадают в общую очередь, а результаты разбирает поток-диспетчер.
+    """
+
+    def __init__(self, workers: int = INFERENCE_WORKERS, queue_size: int = INFERENCE_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.profile = None
+        self.load_seconds = None
+        self._context = multiprocessing.get_context("spawn")
+        self._tasks = None
+        self._results = None
+        self._states: Dict[int, WorkerState] = {}
+        self._controls: Dict[int, object] = {}
+        self._pending: Dict[int, PendingTask] = {}
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        self._ready = threading.Event()
+        self._stopping = False
+        self._last_check = 0.0
+        self.rejected = 0
+        # Причина, по которой пул не может работать (модель не загружается); _ready при этом тоже выставлен
+        self.error: Optional[str] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set() and self.error is None
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return sum(task.size for task in self._pending.values())
+
+    def start(self):
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="inference-dispatcher", daemon=True)
+        self._dispatcher.start()
+        logger.info(f"Запущено процессов инференса: {self.workers}, очередь до {self.queue_size}")
+
+    def _spawn(self, worker_id: int, start_failures: int = 0):
+        controls = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(worker_id, self._tasks, self._results, controls),
+            name=f"inference-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self._controls[worker_id] = controls
+        self._states[worker_id] = WorkerState(worker_id, process, start_failures)
+
+    async def wait_ready(self):
+        """Ждёт загрузки модели во всех процессах; RuntimeError, если процессы не могут её загрузить."""
+        await asyncio.to_thread(self._ready.wait)
+        if self.error is not None:
+            raise RuntimeError(self.error)
+
+    def stop(self):
+        self._stopping = True
+        for worker_id in self._states:
+            self._tasks.put(None)
+            self._controls[worker_id].put(None)
+        for state in self._states.values():
+            state.process.join(WORKER_SHUTDOWN_SECONDS)
+            if state.process.is_alive():
+                state.process.terminate()
+        logger.info("Процессы инференса остановлены")
+
+    def admit(self, waiting: int = 0):
+        """Отказывает с 503, если очередь пула заполнена; waiting — промпты, ещё не переданные в пул."""
+        if self.error is not None:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Модель недоступна")
+        queued = self.queued + waiting
+        if queued < self.queue_size + self.workers:
+            return
+        self.rejected += 1
+        task_seconds = self._average_task_seconds()
+        retry_after = max(1, math.ceil(task_seconds * queued / max(1, self.workers)))
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Очередь генерации заполнена, попробуйте позже",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def _average_task_seconds(self) -> float:
+        done = sum(state.tasks_done for state in self._states.values())
+        busy = sum(state.busy_seconds for state in self._states.values())
+        return busy / done if done else 1.0
+
+    def _submit(self, kind: str, payload, size: int, stream: bool) -> "tuple[int, PendingTask]":
+        task_id = next(self._task_ids)
+        task = PendingTask(asyncio.get_running_loop(), size, stream)
+        with self._lock:
+            self._pending[task_id] = task
+        self._tasks.put((task_id, kind, payload))
+        return task_id, task
+
+    async def generate_batch(self, prompts: List[str], cancels: Optional[List[CancelToken]] = None) -> List[str]:
+        cancels = cancels or [None] * len(prompts)
+        deadlines = [cancel.deadline if cancel is not None else None for cancel in cancels]
+        task_id, task = self._submit("batch", (list(prompts), deadlines), len(prompts), stream=False)
+        for row, cancel in enumerate(cancels):
+            if cancel is not None:
+                cancel.add_callback(lambda row=row: self._cancel(task_id, row))
+        return await task.future
+
+    async def stream(self, prompt_text: str, cache_key=None, cancel: Optional[CancelToken] = None) -> AsyncIterator[str]:
+        deadline = cancel.deadline if cancel is not None else None
+        task_id, task = self._submit("stream", (prompt_text, cache_key, deadline), 1, stream=True)
+        if cancel is not None:
+            cancel.add_callback(lambda: self._cancel(task_id, None))
+        while True:
+            item = await task.tokens.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def _cancel(self, task_id: int, row: Optional[int]):
+        """Передаёт отмену процессу, который выполняет задачу, или запоминает её до старта задачи."""
+        with self._lock:
+            task = self._pending.get(task_id)
+            if task is None:
+                return
+            if task.worker_id is None:
+                task.cancelled_rows.add(row)
+                return
+            controls = self._controls[task.worker_id]
+        controls.put((task_id, row))
+
+    def _dispatch(self):
+        while not self._stopping:
+            try:
+                kind, worker_id, payload = self._results.get(timeout=WORKER_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            state = self._states.get(worker_id)
+            if state is None:
+                continue
+            state.last_heartbeat = time.monotonic()
+            if kind == "metric":
+                metrics.registry.apply(*payload)
+            elif kind == "ready":
+                state.ready = True
+                state.start_failures = 0
+                state.pid = payload["pid"]
+                self.profile = payload["profile"]
+                self.load_seconds = payload["load_seconds"]
+                logger.info(f"Процесс инференса {worker_id} (pid {state.pid}) готов")
+                if all(s.ready for s in self._states.values()):
+                    self._ready.set()
+            elif kind == "load_failed":
+                state.load_error = payload
+            elif kind == "started":
+                state.current_task = payload
+                state.task_started_at = time.monotonic()
+                with self._lock:
+                    task = self._pending.get(payload)
+                    if task is not None:
+                        task.worker_id = worker_id
+                        cancelled_rows, task.cancelled_rows = task.cancelled_rows, set()
+                if task is not None:
+                    for row in cancelled_rows:
+                        self._controls[worker_id].put((payload, row))
+            elif kind == "token":
+                task_id, chunk = payload
+                with self._lock:
+                    task = self._pending.get(task_id)
+                if task is not None:
+                    task.loop.call_soon_threadsafe(task.tokens.put_nowait, chunk)
+            elif kind in ("result", "error"):
+                task_id, result = payload
+                self._finish_task(state, kind == "error")
+                error = RuntimeError(result) if kind == "error" else None
+                self._resolve(task_id, result, error)
+            if time.monotonic() - self._last_check >= WORKER_HEARTBEAT_SECONDS:
+                self._check_workers()
+
+    def _finish_task(self, state: WorkerState, failed: bool):
+        if state.task_started_at is not None:
+            state.busy_seconds += time.monotonic() - state.task_started_at
+        state.current_task = None
+        state.task_started_at = None
+        state.tasks_done += 1
+        state.tasks_failed += int(failed)
+
+    def _resolve(self, task_id: int, result, error: Optional[Exception] = None):
+        with self._lock:
+            task = self._pending.pop(task_id, None)
+        if task is None:
+            return
+        if task.tokens is not None:
+            task.loop.call_soon_threadsafe(task.tokens.put_nowait, error)
+        elif error is not None:
+            task.loop.call_soon_threadsafe(_set_exception, task.future, error)
+        else:
+            task.loop.call_soon_threadsafe(_set_result, task.future, result)
+
+    def _check_workers(self):
+        """Перезапускает упавшие процессы; их текущая задача завершается ошибкой.
+
+        Процесс, который раз за разом падает, не успев загрузить модель, больше не перезапускается:
+        пул помечается неисправным, и wait_ready() завершается ошибкой.
+        """
+        self._last_check = time.monotonic()
+        for worker_id, state in list(self._states.items()):
+            if state.process.is_alive() or self._stopping or self.error is not None:
+                continue
+            if state.current_task is not None:
+                self._resolve(state.current_task, None, RuntimeError("Процесс инференса аварийно завершился"))
+            start_failures = state.start_failures + (0 if state.ready else 1)
+            if start_failures >= WORKER_MAX_START_FAILURES:
+                reason = state.load_error or f"код завершения {state.process.exitcode}"
+                self.error = f"Процесс инференса {worker_id} не запустился {start_failures} раз подряд: {reason}"
+                logger.error(self.error)
+                self._fail_pending(RuntimeError(self.error))
+                self._ready.set()
+                return
+            logger.error(f"Процесс инференса {worker_id} завершился с кодом {state.process.exitcode}, перезапуск")
+            self._spawn(worker_id, start_failures)
+
+    def _fail_pending(self, error: Exception):
+        with self._lock:
+            task_ids = list(self._pending)
+        for task_id in task_ids:
+            self._resolve(task_id, None, error)
+
+    def health(self) -> dict:
+        return {
+            "workers": [state.health() for state in self._states.values()],
+            "queued": self.queued,
+            "queue_size": self.queue_size,
+            "rejected": self.rejected,
+            "error": self.error,
+        }
+
+def _set_result(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _set_exception(future: asyncio.Future, error: Exception):
+    if not future.done():
+        future.set_exception(error)
+
+def create_inference_pool() -> Optional[InferencePool]:
+    if INFERENCE_WORKERS <= 0:
+        return None
+    return InferencePool()